@@ -1,5 +1,7 @@
 """This module contains request handlers for  admin-only access."""
 
+import cache_purge
+
 import datetime
 import logging
 import webapp2
@@ -19,9 +21,37 @@ class SearchCacheHandler(webapp2.RequestHandler):
         self.response.set_status(202) # Accepted
 
 class ClearCacheHandler(webapp2.RequestHandler):
+    """Starts a sharded mapreduce job that deletes cache entities.
+
+    Optional parameters: kind (default CacheItem), prefix (key name prefix),
+    max_age_days and shards. Responds with the job's status page.
+    """
+    def get(self):
+        kind = self.request.get('kind', 'CacheItem')
+        prefix = self.request.get('prefix', None)
+        max_age_days = self.request.get('max_age_days', None)
+        if max_age_days:
+            try:
+                max_age_days = float(max_age_days)
+            except ValueError:
+                self.error(400)
+                return
+        else:
+            max_age_days = None
+        shards = self.request.get_range('shards', min_value=1, max_value=256, 
+            default=8)
+        mapreduce_id = cache_purge.start_purge(kind=kind, prefix=prefix, 
+            max_age_days=max_age_days, shard_count=shards)
+        logging.info('Started cache purge job %s' % mapreduce_id)
+        self.response.set_status(202) # Accepted
+        self.response.headers['Location'] = (
+            '/mapreduce/detail?mapreduce_id=%s' % mapreduce_id)
+        self.response.out.write(mapreduce_id)
+
+class ClearLegacyTileCacheHandler(webapp2.RequestHandler):
     def get(self):
         taskqueue.add(
-            url='/backend/clear_search_cache', 
+            url='/backend/clear_legacy_tile_cache', 
             queue_name='clear-search-cache', 
             eta=datetime.datetime.now(), 
             target='search-cache-builder-backend')            
@@ -45,11 +75,45 @@ class SearchResponseHandler(webapp2.RequestHandler):
             target='search-cache-builder-backend')            
         self.response.set_status(202) # Accepted
 
+class PrewarmVectorTilesHandler(webapp2.RequestHandler):
+    """Enqueues a vector tile request for every tile of a layer up to a zoom."""
+
+    # 4^0 + ... + 4^6 = 5461 tiles, keep pre-warming to the low zooms
+    MAX_ZOOM = 6
+
+    def get(self):
+        sql = self.request.get('sql', None)
+        if not sql:
+            self.error(400)
+            return
+        layer = self.request.get('layer', 'mol_style')
+        minzoom = self.request.get_range('minzoom', min_value=0, 
+            max_value=self.MAX_ZOOM, default=0)
+        maxzoom = self.request.get_range('maxzoom', min_value=minzoom, 
+            max_value=self.MAX_ZOOM, default=4)
+        queue = taskqueue.Queue('prewarm-vector-tiles')
+        tasks = []
+        for z in range(minzoom, maxzoom + 1):
+            for x in range(1 << z):
+                for y in range(1 << z):
+                    tasks.append(taskqueue.Task(
+                        url='/tiles/%s/%s/%s/%s.geojson' % (layer, z, x, y),
+                        params=dict(sql=sql), 
+                        method='GET'))
+                    if len(tasks) == taskqueue.MAX_TASKS_PER_ADD:
+                        queue.add(tasks)
+                        tasks = []
+        if tasks:
+            queue.add(tasks)
+        self.response.set_status(202) # Accepted
+
 application = webapp2.WSGIApplication(
          [('/admin/build-search-cache', SearchCacheHandler),
           ('/admin/clear-search-cache', ClearCacheHandler),
+          ('/admin/clear-legacy-tile-cache', ClearLegacyTileCacheHandler),
           ('/admin/build-autocomplete', AutoCompleteHandler),
-          ('/admin/build-search-response', SearchResponseHandler)],
+          ('/admin/build-search-response', SearchResponseHandler),
+          ('/admin/prewarm-vector-tiles', PrewarmVectorTilesHandler)],
          debug=True)
 
 def main():
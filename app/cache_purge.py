@@ -0,0 +1,198 @@
+"""This module purges cache entities with a sharded mapreduce job.
+
+The job splits the kind into key ranges (one or more per shard) with the
+bundled mapreduce library, so a multi-million entity cache is deleted by many
+tasks in parallel and an interrupted shard resumes where it stopped. Deletes go
+through the mapreduce MutationPool, which batches them into asynchronous RPCs.
+
+Progress is reported in the mapreduce status UI (/mapreduce/status) through
+the job's 'cache-purge-deleted' counter.
+"""
+
+import datetime
+import re
+import time
+
+from google.appengine.api import datastore
+from google.appengine.datastore import datastore_query
+from google.appengine.ext import db
+
+from mapreduce import control
+from mapreduce import input_readers
+from mapreduce import operation as op
+from mapreduce.lib import key_range
+
+# Counts the entities deleted by a purge job.
+COUNTER_DELETED = 'cache-purge-deleted'
+
+# The number of keys passed to purge() at once.
+HANDLER_BATCH_SIZE = 100
+
+# The stored name of CacheItem.created.
+CREATED_PROPERTY = 'c'
+
+class CachePurgeInputReader(input_readers.DatastoreKeyInputReader):
+    """Yields the keys of a kind's entities, optionally restricted to key names
+    starting with a prefix or matching a pattern, and to entities created
+    before a cutoff.
+
+    Key ranges are split over the whole kind, then narrowed to the prefix, so
+    shards outside of it finish immediately. The prefix is lowercased, as cache
+    keys are (see cache.CacheItem.create). The age filter projects only the
+    created property, so blobs are never loaded; entities without one are not
+    in its index and are skipped.
+    """
+
+    KEY_PREFIX_PARAM = 'key_prefix'
+    KEY_PATTERN_PARAM = 'key_pattern'
+    CREATED_BEFORE_PARAM = 'created_before'
+    CREATED_PROPERTY_PARAM = 'created_property'
+
+    @classmethod
+    def validate(cls, mapper_spec):
+        super(CachePurgeInputReader, cls).validate(mapper_spec)
+        params = mapper_spec.params
+        if not isinstance(params.get(cls.KEY_PREFIX_PARAM) or '', basestring):
+            raise input_readers.BadReaderParamsError(
+                "Expected a string key_prefix")
+        if params.get(cls.CREATED_BEFORE_PARAM) is not None:
+            try:
+                float(params[cls.CREATED_BEFORE_PARAM])
+            except ValueError, e:
+                raise input_readers.BadReaderParamsError(
+                    "Bad created_before: %s" % e)
+        if params.get(cls.KEY_PATTERN_PARAM):
+            try:
+                re.compile(params[cls.KEY_PATTERN_PARAM])
+            except re.error, e:
+                raise input_readers.BadReaderParamsError(
+                    "Bad key_pattern: %s" % e)
+
+    @classmethod
+    def split_input(cls, mapper_spec):
+        readers = super(CachePurgeInputReader, cls).split_input(mapper_spec)
+        for reader in readers:
+            if reader:
+                reader._set_filters(mapper_spec.params)
+        return readers
+
+    def _set_filters(self, params):
+        self._key_prefix = (params.get(self.KEY_PREFIX_PARAM) or '').lower() or None
+        self._key_pattern = params.get(self.KEY_PATTERN_PARAM) or None
+        self._created_before = params.get(self.CREATED_BEFORE_PARAM)
+        self._created_property = params.get(
+            self.CREATED_PROPERTY_PARAM, CREATED_PROPERTY)
+
+    def to_json(self):
+        json = super(CachePurgeInputReader, self).to_json()
+        json[self.KEY_PREFIX_PARAM] = self._key_prefix
+        json[self.KEY_PATTERN_PARAM] = self._key_pattern
+        json[self.CREATED_BEFORE_PARAM] = self._created_before
+        json[self.CREATED_PROPERTY_PARAM] = self._created_property
+        return json
+
+    @classmethod
+    def from_json(cls, json):
+        reader = super(CachePurgeInputReader, cls).from_json(json)
+        reader._set_filters(json)
+        return reader
+
+    def _prefix_range(self, k_range):
+        """Returns k_range narrowed to key names starting with the prefix, or
+        None if it has no keys in common with the prefix."""
+        kind = self._entity_kind.split('.')[-1]
+        first = db.Key.from_path(kind, self._key_prefix,
+            namespace=k_range.namespace, _app=k_range._app)
+        last = db.Key.from_path(kind, self._key_prefix + u'\ufffd',
+            namespace=k_range.namespace, _app=k_range._app)
+
+        key_start, include_start = k_range.key_start, k_range.include_start
+        if key_start is None or key_start < first:
+            key_start, include_start = first, True
+        key_end, include_end = k_range.key_end, k_range.include_end
+        if key_end is None or key_end > last:
+            key_end, include_end = last, False
+        if key_start > key_end:
+            return None
+
+        return key_range.KeyRange(key_start=key_start, key_end=key_end,
+            direction=k_range.direction, include_start=include_start,
+            include_end=include_end, namespace=k_range.namespace,
+            _app=k_range._app)
+
+    def _iter_key_range(self, k_range):
+        if self._key_prefix:
+            k_range = self._prefix_range(k_range)
+            if k_range is None:
+                return
+
+        keys = self._iter_created_before(k_range)
+        if self._key_pattern:
+            pattern = re.compile(self._key_pattern)
+            keys = ((key, o) for (key, o) in keys
+                    if key.name() and pattern.match(key.name()))
+        for key, o in keys:
+            yield key, o
+
+    def _iter_created_before(self, k_range):
+        """Yields the keys in k_range, of entities created before the cutoff if
+        one is set."""
+        if self._created_before is None:
+            for o in super(CachePurgeInputReader, self)._iter_key_range(k_range):
+                yield o
+            return
+
+        cutoff = datetime.datetime.utcfromtimestamp(float(self._created_before))
+        query = datastore.Query(self._entity_kind.split('.')[-1],
+            namespace=k_range.namespace, _app=k_range._app,
+            projection=(self._created_property,))
+        query.Order(('__key__', datastore.Query.ASCENDING))
+        query = k_range.filter_datastore_query(query)
+        for entity in query.Run(
+            config=datastore_query.QueryOptions(batch_size=self._batch_size)):
+            if entity[self._created_property] < cutoff:
+                yield entity.key(), entity.key()
+
+def purge(keys):
+    """Mapper handler: deletes a batch of keys."""
+    for key in keys:
+        yield op.db.Delete(key)
+    yield op.counters.Increment(COUNTER_DELETED, len(keys))
+
+def start_purge(kind='CacheItem', prefix=None, max_age_days=None, shard_count=8,
+                queue_name='cache-purge', pattern=None):
+    """Starts a job that deletes entities of a kind, and returns its id.
+
+    Arguments:
+      kind - The entity kind to purge (default CacheItem).
+      prefix - Only delete entities whose key name starts with this.
+      max_age_days - Only delete entities created more than this many days ago.
+      shard_count - The number of shards to run in parallel.
+      queue_name - The task queue to run the job on.
+      pattern - Only delete entities whose key name matches this regex.
+    """
+    params = {
+        'entity_kind': kind,
+        'handler_batch_size': HANDLER_BATCH_SIZE,
+        # Run as fast as the queue allows, not at the default processing rate.
+        'enable_quota': False,
+    }
+    name = 'Purge %s' % kind
+    if prefix:
+        params[CachePurgeInputReader.KEY_PREFIX_PARAM] = prefix
+        name += " keys starting with '%s'" % prefix
+    if pattern:
+        params[CachePurgeInputReader.KEY_PATTERN_PARAM] = pattern
+        name += " keys matching '%s'" % pattern
+    if max_age_days is not None:
+        params[CachePurgeInputReader.CREATED_BEFORE_PARAM] = (
+            time.time() - max_age_days * 24 * 60 * 60)
+        name += ' older than %s days' % max_age_days
+
+    return control.start_map(
+        name,
+        'cache_purge.purge',
+        'cache_purge.CachePurgeInputReader',
+        params,
+        shard_count=shard_count,
+        queue_name=queue_name)
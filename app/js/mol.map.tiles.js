@@ -399,7 +399,7 @@ mol.modules.map.tiles = function(mol) {
     mol.map.tiles.CartoDbTile = Class.extend({
         init: function(layer, map) {
             var sql =  "" + //c is in case cache key starts with a number
-                "SELECT * FROM get_tile('{0}','{1}','{2}','{3}')"
+                "SELECT * FROM get_tile('{0}','{1}','{2}','{3}',{ZOOM})"
                 .format(
                     layer.source,
                     layer.type,
@@ -454,7 +454,7 @@ mol.modules.map.tiles = function(mol) {
                     }
                     url = urlPattern
                         .replace("{HOST}",mol.services.cartodb.tileApi.host)
-                        .replace("{SQL}",sql)
+                        .replace("{SQL}",sql.replace("{ZOOM}",zoom))
                         .replace("{X}",x)
                         .replace("{Y}",y)
                         .replace("{Z}",zoom)
@@ -539,7 +539,7 @@ mol.modules.map.tiles = function(mol) {
                         "'{3}' as dataset_id, " +
                         "'{2}' as scientificname " +
                     "FROM " +
-                        "get_tile('{0}','{1}','{2}','{3}')",
+                        "get_tile('{0}','{1}','{2}','{3}',{ZOOM})",
                 gridUrlPattern = '' +
                     'http://{0}/' +
                     'tiles/generic_style/{z}/{x}/{y}.grid.json?'+
@@ -587,7 +587,8 @@ mol.modules.map.tiles = function(mol) {
                     url = gridUrl
                         .replace('{x}',x)
                         .replace('{y}',y)
-                        .replace('{z}',zoom);
+                        .replace('{z}',zoom)
+                        .replace(/\{ZOOM\}/g,zoom);
 
 
                 $.getJSON(
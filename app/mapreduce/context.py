@@ -35,12 +35,17 @@ __all__ = [
            "DATASTORE_DEADLINE",
            "MAX_ENTITY_COUNT",
            "MAX_POOL_SIZE",
+           "MAX_RPCS_IN_FLIGHT",
+           "MUTATION_RETRIES",
            ]
 
+import logging
 import threading
 
 from google.appengine.api import datastore
+from google.appengine.api import datastore_errors
 from google.appengine.ext import db
+from google.appengine.runtime import apiproxy_errors
 
 
 # Maximum pool size in bytes. Pool will be flushed when reaches this amount.
@@ -54,6 +59,31 @@ MAX_ENTITY_COUNT = 500
 # Deadline in seconds for mutation pool datastore operations.
 DATASTORE_DEADLINE = 15
 
+# Maximum number of mutation pool datastore RPCs running at the same time.
+# Once this many are in flight, the oldest one is waited for before another
+# one is started.
+MAX_RPCS_IN_FLIGHT = 4
+
+# Number of times a put or delete that failed with a transient error is
+# retried.
+MUTATION_RETRIES = 3
+
+# Errors the datastore reports for a batch that is too large (in bytes or
+# entities). Batches of more than one item that fail with these are split in
+# halves and retried instead.
+_BATCH_SIZE_ERRORS = (datastore_errors.BadRequestError,
+                      apiproxy_errors.RequestTooLargeError)
+
+# Errors worth retrying the same operation for.
+_TRANSIENT_ERRORS = (datastore_errors.Timeout,
+                     datastore_errors.InternalError)
+
+# Estimated serialized size in bytes of a property or key apart from its name
+# and value, and of a non-string value.
+_PROPERTY_OVERHEAD = 8
+_KEY_OVERHEAD = 16
+_SCALAR_VALUE_SIZE = 16
+
 # The name of the counter which counts all mapper calls.
 COUNTER_MAPPER_CALLS = "mapper-calls"
 
@@ -78,6 +108,45 @@ def _normalize_key(value):
   else:
     return value
 
+def _estimate_key_size(key):
+  """Estimate the serialized size of a datastore key in bytes."""
+  size = _KEY_OVERHEAD + len(key.app()) + len(key.namespace() or "")
+  for element in key.to_path():
+    if isinstance(element, basestring):
+      size += len(element) + _PROPERTY_OVERHEAD
+    else:
+      size += _SCALAR_VALUE_SIZE
+  return size
+
+
+def _estimate_value_size(value):
+  """Estimate the serialized size of a property value in bytes."""
+  if isinstance(value, str):
+    return len(value)
+  elif isinstance(value, unicode):
+    return len(value.encode("utf-8"))
+  elif isinstance(value, datastore.Key):
+    return _estimate_key_size(value)
+  return _SCALAR_VALUE_SIZE
+
+
+def _estimate_entity_size(entity):
+  """Estimate the serialized size of a datastore entity in bytes.
+
+  This is much cheaper than encoding the entity to measure it. Values that
+  aren't strings or keys are given a fixed size, so the estimate can be off;
+  MutationPool splits and retries batches the datastore rejects.
+  """
+  size = _estimate_key_size(entity.key())
+  for name, value in entity.iteritems():
+    if isinstance(value, list):
+      for item in value:
+        size += len(name) + _PROPERTY_OVERHEAD + _estimate_value_size(item)
+    else:
+      size += len(name) + _PROPERTY_OVERHEAD + _estimate_value_size(value)
+  return size
+
+
 class ItemList(object):
   """Holds list of arbitrary items, and their total size.
 
@@ -120,10 +189,14 @@ class ItemList(object):
 EntityList = ItemList
 
 
-# TODO(user): mutation pool has no error handling at all. Add some.
 class MutationPool(object):
   """Mutation pool accumulates datastore changes to perform them in batch.
 
+  Batches are written with asynchronous RPCs, so the mapper keeps running
+  while they are in flight; at most max_rpcs_in_flight are outstanding at a
+  time. Puts and deletes never overlap, so they are applied in the order they
+  were flushed. flush() waits for every outstanding RPC.
+
   Properties:
     puts: ItemList of entities to put to datastore.
     deletes: ItemList of keys to delete from datastore.
@@ -134,20 +207,25 @@ class MutationPool(object):
   def __init__(self,
                max_pool_size=MAX_POOL_SIZE,
                max_entity_count=MAX_ENTITY_COUNT,
-               mapreduce_spec=None):
+               mapreduce_spec=None,
+               max_rpcs_in_flight=MAX_RPCS_IN_FLIGHT):
     """Constructor.
 
     Args:
       max_pool_size: maximum pools size in bytes before flushing it to db.
       max_entity_count: maximum number of entities before flushing it to db.
       mapreduce_spec: An optional instance of MapperSpec.
+      max_rpcs_in_flight: maximum number of datastore RPCs to keep running.
     """
     self.max_pool_size = max_pool_size
     self.max_entity_count = max_entity_count
+    self.max_rpcs_in_flight = max_rpcs_in_flight
     params = mapreduce_spec.params if mapreduce_spec is not None else {}
     self.force_writes = bool(params.get("force_ops_writes", False))
     self.puts = ItemList()
     self.deletes = ItemList()
+    # (rpc, operation function, items, retry count) for each RPC in flight.
+    self._rpcs = []
 
   def put(self, entity):
     """Registers entity to put to datastore.
@@ -156,7 +234,7 @@ class MutationPool(object):
       entity: an entity or model instance to put.
     """
     actual_entity = _normalize_entity(entity)
-    entity_size = len(actual_entity._ToPb().Encode())
+    entity_size = _estimate_entity_size(actual_entity)
     if (self.puts.length >= self.max_entity_count or
         (self.puts.size + entity_size) > self.max_pool_size):
       self.__flush_puts()
@@ -168,32 +246,87 @@ class MutationPool(object):
     Args:
       entity: an entity, model instance, or key to delete.
     """
-    # This is not very nice: we're calling two protected methods here...
     key = _normalize_key(entity)
-    key_size = len(key._ToPb().Encode())
+    key_size = _estimate_key_size(key)
     if (self.deletes.length >= self.max_entity_count or
         (self.deletes.size + key_size) > self.max_pool_size):
       self.__flush_deletes()
     self.deletes.append(key, key_size)
 
-  # TODO(user): some kind of error handling/retries is needed here.
   def flush(self):
     """Flush(apply) all changed to datastore."""
     self.__flush_puts()
     self.__flush_deletes()
+    self.__wait_all()
 
   def __flush_puts(self):
-    """Flush all puts to datastore."""
+    """Start writing all puts to datastore."""
     if self.puts.length:
-      datastore.Put(self.puts.items, config=self.__create_config())
+      self.__start(datastore.PutAsync, self.puts.items)
     self.puts.clear()
 
   def __flush_deletes(self):
-    """Flush all deletes to datastore."""
+    """Start writing all deletes to datastore."""
     if self.deletes.length:
-      datastore.Delete(self.deletes.items, config=self.__create_config())
+      self.__start(datastore.DeleteAsync, self.deletes.items)
     self.deletes.clear()
 
+  def __start(self, operation, items):
+    """Start an asynchronous datastore RPC, keeping the RPC count bounded.
+
+    Args:
+      operation: datastore.PutAsync or datastore.DeleteAsync.
+      items: list of entities or keys to pass to operation.
+    """
+    if self._rpcs and self._rpcs[0][1] is not operation:
+      self.__wait_all()
+    while len(self._rpcs) >= self.max_rpcs_in_flight:
+      self.__wait(*self._rpcs.pop(0))
+    self._rpcs.append(self.__call(operation, items, 0))
+
+  def __call(self, operation, items, retries):
+    """Issue a datastore RPC.
+
+    Returns:
+      A tuple of (rpc, operation, items, retries) to pass to __wait.
+    """
+    rpc = operation(items, config=self.__create_config())
+    return (rpc, operation, items, retries)
+
+  def __wait(self, rpc, operation, items, retries):
+    """Wait for a datastore RPC, retrying it if it failed.
+
+    A batch rejected for its size is split in halves, which are retried
+    separately. An operation that failed with a transient error is retried up
+    to MUTATION_RETRIES times. Other errors are raised right away, as they
+    would fail again however the batch was split.
+
+    Raises:
+      datastore_errors.Error: if the RPC failed and can't be retried.
+      apiproxy_errors.RequestTooLargeError: if a single item is too large.
+    """
+    try:
+      rpc.get_result()
+    except (datastore_errors.Error, apiproxy_errors.RequestTooLargeError), e:
+      if len(items) > 1 and isinstance(e, _BATCH_SIZE_ERRORS):
+        logging.warning("Datastore batch of %d failed with %s; splitting it.",
+                        len(items), e)
+        middle = len(items) // 2
+        halves = [self.__call(operation, items[:middle], retries),
+                  self.__call(operation, items[middle:], retries)]
+        for half in halves:
+          self.__wait(*half)
+      elif retries < MUTATION_RETRIES and isinstance(e, _TRANSIENT_ERRORS):
+        logging.warning("Datastore operation failed with %s; retrying.", e)
+        self.__wait(*self.__call(operation, items, retries + 1))
+      else:
+        raise
+
+  def __wait_all(self):
+    """Wait for all datastore RPCs in flight."""
+    while self._rpcs:
+      self.__wait(*self._rpcs.pop(0))
+
   def __create_config(self):
     """Creates datastore Config.
 
@@ -30,8 +30,10 @@ import os
 import time
 
 from google.appengine.api import memcache
+from google.appengine.api import runtime
 from google.appengine.api import taskqueue
 from google.appengine.ext import db
+from google.appengine.runtime import apiproxy_errors
 from mapreduce import base_handler
 from mapreduce import context
 from mapreduce import errors
@@ -49,6 +51,20 @@ _QUOTA_BATCH_SIZE = 20
 # scheduled as soon as current one takes this long.
 _SLICE_DURATION_SEC = 15
 
+# Mapper parameter overriding _SLICE_DURATION_SEC for a single job.
+_SLICE_DURATION_PARAM = "slice_duration_sec"
+
+# Mapper parameter which switches the worker to batched mode: the handler is
+# called with lists of up to this many input values instead of one at a time.
+_HANDLER_BATCH_SIZE_PARAM = "handler_batch_size"
+
+# Weight of the latest handler call when updating the expected call duration.
+_CALL_DURATION_SMOOTHING = 0.2
+
+# Garbage is only collected after a slice if the instance is using more
+# memory than this, in megabytes.
+_GC_THRESHOLD_MB = 96
+
 # Delay between consecutive controller callback invocations.
 _CONTROLLER_PERIOD_SEC = 2
 
@@ -92,9 +108,29 @@ def _run_task_hook(hooks, method, task, queue_name):
   return False
 
 
+def _should_collect_garbage():
+  """Checks whether the instance uses enough memory to collect garbage.
+
+  Returns:
+    True if memory usage is above _GC_THRESHOLD_MB or can't be determined.
+  """
+  try:
+    return runtime.memory_usage().current() > _GC_THRESHOLD_MB
+  except apiproxy_errors.Error:
+    return True
+
+
 class MapperWorkerCallbackHandler(util.HugeTaskHandler):
   """Callback handler for mapreduce worker task.
 
+  Mapper parameters understood by the worker:
+    enable_quota: set to False to process without quota checks.
+    slice_duration_sec: target wall time of a slice in seconds. A slice ends
+      early if the next handler call is expected to overrun it.
+    handler_batch_size: if set, the handler is called with lists of up to
+      this many input values (tuples when the reader expands parameters)
+      instead of once per value.
+
   Request Parameters:
     mapreduce_spec: MapreduceSpec of the mapreduce serialized to json.
     shard_id: id of the shard.
@@ -111,6 +147,10 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
     tstate = model.TransientShardState.from_request(self.request)
     spec = tstate.mapreduce_spec
     self._start_time = self._time()
+    self._last_call_time = self._start_time
+    self._call_duration = None
+    self._slice_duration = float(spec.mapper.params.get(
+        _SLICE_DURATION_PARAM, _SLICE_DURATION_SEC))
     shard_id = tstate.shard_id
 
     shard_state, control = db.get([
@@ -145,12 +185,16 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
       return
 
     input_reader = tstate.input_reader
+    handler_batch_size = int(
+        spec.mapper.params.get(_HANDLER_BATCH_SIZE_PARAM) or 0)
 
     if spec.mapper.params.get("enable_quota", True):
+      # Take quota from memcache at least a handler batch at a time, so
+      # checking quota for each value stays a local operation.
       quota_consumer = quota.QuotaConsumer(
           quota.QuotaManager(memcache.Client()),
           shard_id,
-          _QUOTA_BATCH_SIZE)
+          max(_QUOTA_BATCH_SIZE, handler_batch_size))
     else:
       quota_consumer = None
 
@@ -165,14 +209,24 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
         # We shouldn't fetch an entity from the reader if there's not enough
         # quota to process it. Perform all quota checks proactively.
         if not quota_consumer or quota_consumer.consume():
+          batch = []
           for entity in input_reader:
             if isinstance(entity, db.Model):
               shard_state.last_work_item = repr(entity.key())
             else:
               shard_state.last_work_item = repr(entity)[:100]
 
-            scan_aborted = not self.process_data(
-                entity, input_reader, ctx, tstate)
+            if not handler_batch_size:
+              scan_aborted = not self.process_data(
+                  entity, input_reader, ctx, tstate)
+            elif entity is input_readers.ALLOW_CHECKPOINT:
+              scan_aborted = not self.process_batch(batch, ctx, tstate)
+              batch = []
+            else:
+              batch.append(entity)
+              if len(batch) >= handler_batch_size:
+                scan_aborted = not self.process_batch(batch, ctx, tstate)
+                batch = []
 
             # Check if we've got enough quota for the next entity.
             if (quota_consumer and not scan_aborted and
@@ -180,6 +234,11 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
               scan_aborted = True
             if scan_aborted:
               break
+
+          # The reader has moved past these values already, so they have to
+          # be processed before the slice ends.
+          if batch:
+            self.process_batch(batch, ctx, tstate)
         else:
           scan_aborted = True
 
@@ -236,7 +295,8 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
     # if there were any exceptions in code before it.
     if shard_state.active:
       self.reschedule(shard_state, tstate)
-    gc.collect()
+    if _should_collect_garbage():
+      gc.collect()
 
   def process_data(self, data, input_reader, ctx, transient_shard_state):
     """Process a single data piece.
@@ -260,21 +320,79 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
       else:
         result = handler(data)
 
-      if util.is_generator(handler):
-        for output in result:
-          if isinstance(output, operation.Operation):
-            output(ctx)
+      self._process_result(handler, result, ctx, transient_shard_state)
+
+    return self._continue_slice(data is not input_readers.ALLOW_CHECKPOINT)
+
+  def process_batch(self, batch, ctx, transient_shard_state):
+    """Process a list of data pieces with a single handler call.
+
+    Args:
+      batch: a list of data to process. May be empty.
+      ctx: current execution context.
+      transient_shard_state: an instance of TransientShardState.
+
+    Returns:
+      True if scan should be continued, False if scan should be aborted.
+    """
+    if batch:
+      # Counts items, not handler calls, so the processed count and rate in
+      # the status UI match unbatched jobs.
+      ctx.counters.increment(context.COUNTER_MAPPER_CALLS, len(batch))
+
+      handler = ctx.mapreduce_spec.mapper.handler
+      result = handler(batch)
+      self._process_result(handler, result, ctx, transient_shard_state)
+
+    return self._continue_slice(bool(batch))
+
+  def _process_result(self, handler, result, ctx, transient_shard_state):
+    """Apply operations and write output yielded by a handler call.
+
+    Args:
+      handler: the mapper handler.
+      result: the value returned by the handler.
+      ctx: current execution context.
+      transient_shard_state: an instance of TransientShardState.
+    """
+    if util.is_generator(handler):
+      for output in result:
+        if isinstance(output, operation.Operation):
+          output(ctx)
+        else:
+          output_writer = transient_shard_state.output_writer
+          if not output_writer:
+            logging.error(
+                "Handler yielded %s, but no output writer is set.", output)
           else:
-            output_writer = transient_shard_state.output_writer
-            if not output_writer:
-              logging.error(
-                  "Handler yielded %s, but no output writer is set.", output)
-            else:
-              output_writer.write(output, ctx)
+            output_writer.write(output, ctx)
+
+  def _continue_slice(self, handler_called):
+    """Decide whether the slice has time for another handler call.
+
+    The expected duration of a call (including reading its input) is a moving
+    average over the calls made so far, so the slice ends before a call that
+    would likely overrun the slice duration rather than after it.
+
+    Args:
+      handler_called: True if the handler was called since the last check.
+
+    Returns:
+      True if scan should be continued, False if scan should be aborted.
+    """
+    now = self._time()
+    if handler_called:
+      duration = now - self._last_call_time
+      if self._call_duration is None:
+        self._call_duration = duration
+      else:
+        self._call_duration += _CALL_DURATION_SMOOTHING * (
+            duration - self._call_duration)
+      self._last_call_time = now
 
-    if self._time() - self._start_time > _SLICE_DURATION_SEC:
-      logging.debug("Spent %s seconds. Rescheduling",
-                    self._time() - self._start_time)
+    elapsed = now - self._start_time
+    if elapsed + (self._call_duration or 0) > self._slice_duration:
+      logging.debug("Spent %s seconds. Rescheduling", elapsed)
       return False
     return True
 
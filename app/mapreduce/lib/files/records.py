@@ -82,6 +82,7 @@ C will be stored as a FULL record in the fourth block.
 
 
 import logging
+import os
 import struct
 
 import google
@@ -271,10 +272,33 @@ class RecordsWriter(object):
 
 
 class RecordsReader(object):
-  """A reader for records format."""
+  """A reader for records format.
+
+  The underlying file is read a block at a time. Record headers are unpacked
+  in place from the block buffer and each payload is sliced out of it once,
+  so reading a record makes no calls to the underlying reader of its own.
+  Fragments of a multi-block record are joined once, when its LAST fragment
+  is read.
+  """
 
   def __init__(self, reader):
     self.__reader = reader
+    # Data read ahead from the reader, from file offset self.__offset up to
+    # the end of its block (or of the file), and the position in it.
+    self.__block = ''
+    self.__offset = reader.tell()
+    self.__pos = 0
+
+  def __fill(self):
+    """Read the rest of the current block into the buffer.
+
+    Returns:
+      False if the end of file was reached.
+    """
+    self.__offset += self.__pos
+    self.__pos = 0
+    self.__block = self.__reader.read(BLOCK_SIZE - self.__offset % BLOCK_SIZE)
+    return bool(self.__block)
 
   def __try_read_record(self):
     """Try reading a record.
@@ -285,47 +309,57 @@ class RecordsReader(object):
       EOFError: when end of file was reached.
       InvalidRecordError: when valid record could not be read.
     """
-    block_remaining = BLOCK_SIZE - self.__reader.tell() % BLOCK_SIZE
+    if self.__pos >= len(self.__block) and not self.__fill():
+      raise EOFError('Read 0 bytes instead of %s' % HEADER_LENGTH)
+
+    block = self.__block
+    pos = self.__pos
+    block_remaining = BLOCK_SIZE - (self.__offset + pos) % BLOCK_SIZE
     if block_remaining < HEADER_LENGTH:
       return ('', RECORD_TYPE_NONE)
 
-    header = self.__reader.read(HEADER_LENGTH)
-    if len(header) != HEADER_LENGTH:
+    if len(block) - pos < HEADER_LENGTH:
+      self.__pos = len(block)
       raise EOFError('Read %s bytes instead of %s' %
-                     (len(header), HEADER_LENGTH))
+                     (len(block) - pos, HEADER_LENGTH))
 
-    (masked_crc, length, record_type) = struct.unpack(HEADER_FORMAT, header)
-    crc = _unmask_crc(masked_crc)
+    (masked_crc, length, record_type) = struct.unpack_from(
+        HEADER_FORMAT, block, pos)
+    pos += HEADER_LENGTH
+    self.__pos = pos
 
     if length + HEADER_LENGTH > block_remaining:
 
       raise InvalidRecordError('Length is too big')
 
-    data = self.__reader.read(length)
-    if len(data) != length:
+    end = pos + length
+    if end > len(block):
+      self.__pos = len(block)
       raise EOFError('Not enough data read. Expected: %s but got %s' %
-                     (length, len(data)))
+                     (length, len(block) - pos))
+    self.__pos = end
 
     if record_type == RECORD_TYPE_NONE:
       return ('', record_type)
 
-    actual_crc = crc32c.crc_update(crc32c.CRC_INIT, [record_type])
-    actual_crc = crc32c.crc_update(actual_crc, data)
+    # The checksum covers the record type, which is the last header byte, and
+    # the data right after it.
+    actual_crc = crc32c.crc_update(crc32c.CRC_INIT, block[pos - 1:end])
     actual_crc = crc32c.crc_finalize(actual_crc)
+    data = block[pos:end]
 
-    if actual_crc != crc:
+    if actual_crc != _unmask_crc(masked_crc):
       raise InvalidRecordError('Data crc does not match')
     return (data, record_type)
 
   def __sync(self):
     """Skip reader to the block boundary."""
-    pad_length = BLOCK_SIZE - self.__reader.tell() % BLOCK_SIZE
-    if pad_length and pad_length != BLOCK_SIZE:
-      self.__reader.read(pad_length)
+    # The buffer always ends at a block boundary or the end of file.
+    self.__pos = len(self.__block)
 
   def read(self):
     """Reads record from current position in reader."""
-    data = None
+    chunks = None
     while True:
       last_offset = self.tell()
       try:
@@ -333,40 +367,39 @@ class RecordsReader(object):
         if record_type == RECORD_TYPE_NONE:
           self.__sync()
         elif record_type == RECORD_TYPE_FULL:
-          if data is not None:
+          if chunks is not None:
             logging.warning(
                 "Ordering corruption: Got FULL record while already "
                 "in a chunk at offset %d", last_offset)
           return chunk
         elif record_type == RECORD_TYPE_FIRST:
-          if data is not None:
+          if chunks is not None:
             logging.warning(
                 "Ordering corruption: Got FIRST record while already "
                 "in a chunk at offset %d", last_offset)
-          data = chunk
+          chunks = [chunk]
         elif record_type == RECORD_TYPE_MIDDLE:
-          if data is None:
+          if chunks is None:
             logging.warning(
                 "Ordering corruption: Got MIDDLE record before FIRST "
                 "record at offset %d", last_offset)
           else:
-            data += chunk
+            chunks.append(chunk)
         elif record_type == RECORD_TYPE_LAST:
-          if data is None:
+          if chunks is None:
             logging.warning(
                 "Ordering corruption: Got LAST record but no chunk is in "
                 "progress at offset %d", last_offset)
           else:
-            result = data + chunk
-            data = None
-            return result
+            chunks.append(chunk)
+            return "".join(chunks)
         else:
           raise InvalidRecordError("Unsupported record type: %s" % record_type)
 
       except InvalidRecordError, e:
         logging.warning("Invalid record encountered at %s (%s). Syncing to "
                         "the next block", last_offset, e)
-        data = None
+        chunks = None
         self.__sync()
 
   def __iter__(self):
@@ -378,11 +411,21 @@ class RecordsReader(object):
 
   def tell(self):
     """Return file's current position."""
-    return self.__reader.tell()
+    return self.__offset + self.__pos
 
-  def seek(self, *args, **kwargs):
+  def seek(self, offset, whence=os.SEEK_SET):
     """Set the file's current position.
 
-    Arguments are passed directly to the underlying reader.
+    Args:
+      offset: seek offset as number.
+      whence: seek mode. Supported modes are os.SEEK_SET (absolute seek),
+        and os.SEEK_CUR (seek relative to the current position).
     """
-    return self.__reader.seek(*args, **kwargs)
+    if whence == os.SEEK_CUR:
+      offset += self.tell()
+    elif whence != os.SEEK_SET:
+      raise ValueError('Whence mode %d is not supported' % whence)
+    self.__reader.seek(offset)
+    self.__block = ''
+    self.__offset = offset
+    self.__pos = 0
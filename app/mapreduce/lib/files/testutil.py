@@ -21,10 +21,21 @@
 """Testing utils for writing tests involving Files API."""
 
 
-__all__ = ['TestFileServiceStub']
+__all__ = ['TestFileServiceStub', 'LocalFileServiceStub']
 
 
+import datetime
+import mmap
+import os
+import shutil
+import uuid
+
 from google.appengine.api import apiproxy_stub
+from google.appengine.api import datastore
+from mapreduce.lib.files import blobstore as files_blobstore
+from mapreduce.lib.files import file_service_pb
+from google.appengine.ext import blobstore
+from google.appengine.runtime import apiproxy_errors
 
 
 class TestFileServiceStub(apiproxy_stub.APIProxyStub):
@@ -62,3 +73,221 @@ class TestFileServiceStub(apiproxy_stub.APIProxyStub):
   def set_content(self, filename, content):
     """Set current in-memory file content."""
     self._file_content[filename] = content
+
+
+class LocalFileServiceStub(apiproxy_stub.APIProxyStub):
+  """A FileServiceStub keeping blobstore files in a local directory.
+
+  Supports creating, appending to, finalizing and reading blobstore files, so
+  the mapreduce shuffler and output writers can run outside of App Engine:
+
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        'file', LocalFileServiceStub('/tmp/files'))
+
+  Finalizing a file stores its BlobInfo and blob file index entities, so a
+  datastore stub has to be registered too. Finalized files are read through
+  memory maps.
+  """
+
+  def __init__(self, root_dir):
+    """Constructor.
+
+    Args:
+      root_dir: directory to keep file content in. Created if missing.
+    """
+    super(LocalFileServiceStub, self).__init__('file')
+    self._root_dir = root_dir
+    if not os.path.isdir(root_dir):
+      os.makedirs(root_dir)
+    # Ticket of every writable file to its content type.
+    self._writable = {}
+    # Ticket to last sequence key written.
+    self._sequence_keys = {}
+    # Ticket to file object open for append.
+    self._appending = {}
+    # Ticket to (mmap, size) of finalized files.
+    self._maps = {}
+
+  def _ticket(self, filename):
+    """Returns the ticket naming filename's content on disk."""
+    if not filename.startswith(files_blobstore._BLOBSTORE_DIRECTORY):
+      raise apiproxy_errors.ApplicationError(
+          file_service_pb.FileServiceErrors.INVALID_FILE_NAME, filename)
+    ticket = filename[len(files_blobstore._BLOBSTORE_DIRECTORY):]
+    if ticket.startswith(files_blobstore._CREATION_HANDLE_PREFIX):
+      ticket = ticket[len(files_blobstore._CREATION_HANDLE_PREFIX):]
+    return ticket
+
+  def _path(self, ticket):
+    return os.path.join(self._root_dir, ticket)
+
+  def _Dynamic_Create(self, request, response):
+    if request.filesystem() != files_blobstore._BLOBSTORE_FILESYSTEM:
+      raise apiproxy_errors.ApplicationError(
+          file_service_pb.FileServiceErrors.UNSUPPORTED_FILE_SYSTEM,
+          request.filesystem())
+    if request.has_filename():
+      raise apiproxy_errors.ApplicationError(
+          file_service_pb.FileServiceErrors.FILE_NAME_SPECIFIED)
+
+    content_type = 'application/octet-stream'
+    for param in request.parameters_list():
+      if param.name() == files_blobstore._MIME_TYPE_PARAMETER:
+        content_type = param.value()
+
+    ticket = uuid.uuid4().hex
+    open(self._path(ticket), 'wb').close()
+    self._writable[ticket] = content_type
+    response.set_filename(files_blobstore._BLOBSTORE_DIRECTORY +
+                          files_blobstore._CREATION_HANDLE_PREFIX + ticket)
+
+  def _Dynamic_Open(self, request, response):
+    ticket = self._ticket(request.filename())
+    if not os.path.exists(self._path(ticket)):
+      raise apiproxy_errors.ApplicationError(
+          file_service_pb.FileServiceErrors.EXISTENCE_ERROR)
+    if (request.open_mode() == file_service_pb.OpenRequest.APPEND and
+        ticket not in self._writable):
+      raise apiproxy_errors.ApplicationError(
+          file_service_pb.FileServiceErrors.FINALIZATION_ERROR)
+
+  def _Dynamic_Append(self, request, response):
+    ticket = self._ticket(request.filename())
+    if ticket not in self._writable:
+      raise apiproxy_errors.ApplicationError(
+          file_service_pb.FileServiceErrors.FINALIZATION_ERROR)
+    if request.has_sequence_key():
+      last_sequence_key = self._sequence_keys.get(ticket)
+      if (last_sequence_key is not None and
+          request.sequence_key() <= last_sequence_key):
+        raise apiproxy_errors.ApplicationError(
+            file_service_pb.FileServiceErrors.SEQUENCE_KEY_OUT_OF_ORDER,
+            last_sequence_key)
+      self._sequence_keys[ticket] = request.sequence_key()
+
+    f = self._appending.get(ticket)
+    if f is None:
+      f = self._appending[ticket] = open(self._path(ticket), 'ab')
+    f.write(request.data())
+
+  def _Dynamic_Close(self, request, response):
+    ticket = self._ticket(request.filename())
+    f = self._appending.pop(ticket, None)
+    if f is not None:
+      f.close()
+    if request.finalize():
+      self._finalize(ticket)
+
+  def _finalize(self, ticket):
+    """Stores the blob entities of a finalized file."""
+    if ticket not in self._writable:
+      raise apiproxy_errors.ApplicationError(
+          file_service_pb.FileServiceErrors.FINALIZATION_ERROR)
+    content_type = self._writable.pop(ticket)
+    self._sequence_keys.pop(ticket, None)
+
+    creation_handle = files_blobstore._CREATION_HANDLE_PREFIX + ticket
+    blob_info = datastore.Entity(blobstore.BLOB_INFO_KIND, name=ticket,
+                                 namespace='')
+    blob_info['content_type'] = content_type
+    blob_info['creation'] = datetime.datetime.utcnow()
+    blob_info['filename'] = ticket
+    blob_info['size'] = os.path.getsize(self._path(ticket))
+    blob_info['creation_handle'] = creation_handle
+    blob_file_index = datastore.Entity(files_blobstore._BLOB_FILE_INDEX_KIND,
+                                       name=creation_handle, namespace='')
+    blob_file_index[files_blobstore._BLOB_KEY_PROPERTY_NAME] = ticket
+    datastore.Put([blob_info, blob_file_index])
+
+  def _Dynamic_Read(self, request, response):
+    ticket = self._ticket(request.filename())
+    if ticket in self._writable:
+      raise apiproxy_errors.ApplicationError(
+          file_service_pb.FileServiceErrors.WRONG_OPEN_MODE)
+
+    if ticket not in self._maps:
+      with open(self._path(ticket), 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+          content = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        else:
+          content = ''
+      self._maps[ticket] = (content, size)
+    content, size = self._maps[ticket]
+
+    pos = min(request.pos(), size)
+    response.set_data(content[pos:pos + request.max_bytes()])
+
+  def _Dynamic_GetCapabilities(self, request, response):
+    response.add_filesystem(files_blobstore._BLOBSTORE_FILESYSTEM)
+    response.set_shuffle_available(False)
+
+  def get_content(self, filename):
+    """Get current file content."""
+    with open(self._path(self._ticket(filename)), 'rb') as f:
+      return f.read()
+
+  def clear(self):
+    """Close all files and delete the root directory's content."""
+    for f in self._appending.values():
+      f.close()
+    for content, _ in self._maps.values():
+      if content:
+        content.close()
+    self._writable.clear()
+    self._sequence_keys.clear()
+    self._appending.clear()
+    self._maps.clear()
+    shutil.rmtree(self._root_dir, ignore_errors=True)
+    os.makedirs(self._root_dir)
+
+
+def _benchmark(record_count=200000, record_size=100):
+  """Time writing and reading records through LocalFileServiceStub.
+
+  Needs the App Engine SDK on the path, but no App Engine environment.
+  """
+  import tempfile
+  import time
+  from google.appengine.api import apiproxy_stub_map
+  from google.appengine.api import datastore_file_stub
+  from mapreduce.lib import files
+  from mapreduce.lib.files import records
+
+  os.environ.setdefault('APPLICATION_ID', 'benchmark')
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  apiproxy_stub_map.apiproxy.RegisterStub(
+      'datastore_v3',
+      datastore_file_stub.DatastoreFileStub(os.environ['APPLICATION_ID'], None))
+  stub = LocalFileServiceStub(tempfile.mkdtemp())
+  apiproxy_stub_map.apiproxy.RegisterStub('file', stub)
+
+  record = 'x' * record_size
+  megabytes = record_count * record_size / float(1 << 20)
+  try:
+    start = time.time()
+    filename = files.blobstore.create()
+    with files.open(filename, 'a') as f:
+      with records.RecordsWriter(f) as writer:
+        for _ in xrange(record_count):
+          writer.write(record)
+    files.finalize(filename)
+    elapsed = time.time() - start
+    print 'write: %.2f MB/s' % (megabytes / elapsed)
+
+    filename = files.blobstore.get_file_name(
+        files.blobstore.get_blob_key(filename))
+    start = time.time()
+    count = 0
+    for _ in records.RecordsReader(files.BufferedFile(filename)):
+      count += 1
+    elapsed = time.time() - start
+    assert count == record_count, count
+    print 'read: %.2f MB/s' % (megabytes / elapsed)
+  finally:
+    stub.clear()
+    shutil.rmtree(stub._root_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  _benchmark()
@@ -16,6 +16,8 @@
 
 """Datastore models used by the Google App Engine Pipeline API."""
 
+import zlib
+
 from google.appengine.ext import db
 from google.appengine.ext import blobstore
 
@@ -62,8 +64,9 @@ class _PipelineRecord(db.Model):
   start_time = db.DateTimeProperty(indexed=False)
   finalized_time = db.DateTimeProperty(indexed=False)
 
-  # One of these two will be set, depending on the size of the params.
+  # One of these three will be set, depending on the size of the params.
   params_text = db.TextProperty(name='params')
+  params_compressed = db.BlobProperty()
   params_blob = blobstore.BlobReferenceProperty(indexed=False)
 
   status = db.StringProperty(choices=(WAITING, RUN, DONE, ABORTED),
@@ -92,6 +95,8 @@ class _PipelineRecord(db.Model):
 
     if self.params_blob is not None:
       value_encoded = self.params_blob.open().read()
+    elif self.params_compressed is not None:
+      value_encoded = zlib.decompress(self.params_compressed)
     else:
       value_encoded = self.params_text
 
@@ -127,8 +132,9 @@ class _SlotRecord(db.Model):
   filler = db.ReferenceProperty(_PipelineRecord,
                                 collection_name='filled_slots_set')
 
-  # One of these two will be set, depending on the size of the value.
+  # One of these three will be set, depending on the size of the value.
   value_text = db.TextProperty(name='value')
+  value_compressed = db.BlobProperty()
   value_blob = blobstore.BlobReferenceProperty(indexed=False)
 
   status = db.StringProperty(choices=(FILLED, WAITING), default=WAITING,
@@ -147,6 +153,8 @@ class _SlotRecord(db.Model):
 
     if self.value_blob is not None:
       encoded_value = self.value_blob.open().read()
+    elif self.value_compressed is not None:
+      encoded_value = zlib.decompress(self.value_compressed)
     else:
       encoded_value = self.value_text
 
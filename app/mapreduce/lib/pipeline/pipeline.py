@@ -36,6 +36,7 @@ import time
 import traceback
 import urllib
 import uuid
+import zlib
 
 from google.appengine.api import mail
 from mapreduce.lib import files
@@ -141,6 +142,12 @@ _DEBUG = False
 
 _MAX_JSON_SIZE = 900000
 
+# JSON values bigger than this are compressed before they are saved.
+_MIN_COMPRESSED_JSON_SIZE = 16 * 1024
+
+# Fast compression; JSON shrinks well even so.
+_JSON_COMPRESSION_LEVEL = 1
+
 _ENFORCE_AUTH = True
 
 ################################################################################
@@ -289,7 +296,8 @@ class PipelineFuture(object):
   def _inherit_outputs(self,
                        pipeline_name,
                        already_defined,
-                       resolve_outputs=False):
+                       resolve_outputs=False,
+                       slot_records=None):
     """Inherits outputs from a calling Pipeline.
 
     Args:
@@ -299,6 +307,8 @@ class PipelineFuture(object):
       resolve_outputs: When True, this method will dereference all output slots
         before returning back to the caller, making those output slots' values
         available.
+      slot_records: Optional. Dictionary of _SlotRecords already fetched, as
+        returned by _get_slot_records.
 
     Raises:
       UnexpectedPipelineError when resolve_outputs is True and any of the output
@@ -322,8 +332,9 @@ class PipelineFuture(object):
 
     if resolve_outputs:
       slot_key_dict = dict((s.key, s) for s in self._output_dict.itervalues())
-      all_slots = db.get(slot_key_dict.keys())
-      for slot, slot_record in zip(slot_key_dict.itervalues(), all_slots):
+      all_slots = _get_slot_records(slot_key_dict.keys(), slot_records)
+      for slot_key, slot in slot_key_dict.iteritems():
+        slot_record = all_slots[slot_key]
         if slot_record is None:
           raise UnexpectedPipelineError(
               'Inherited output named "%s" for pipeline class "%s" is '
@@ -490,13 +501,21 @@ class Pipeline(object):
       return None
 
     params = pipeline_record.params
+    # Fetch the slots of the arguments and outputs in one batch.
+    slot_keys = _get_arg_slot_keys(params['args'], params['kwargs'])
+    if resolve_outputs:
+      slot_keys.update(db.Key(k) for k in params['output_slots'].itervalues())
+    slot_records = _get_slot_records(slot_keys)
+
     arg_list, kwarg_dict = _dereference_args(
-        pipeline_record.class_path, params['args'], params['kwargs'])
+        pipeline_record.class_path, params['args'], params['kwargs'],
+        slot_records=slot_records)
     outputs = PipelineFuture(cls.output_names)
     outputs._inherit_outputs(
         pipeline_record.class_path,
         params['output_slots'],
-        resolve_outputs=resolve_outputs)
+        resolve_outputs=resolve_outputs,
+        slot_records=slot_records)
 
     stage = cls(*arg_list, **kwarg_dict)
     stage.backoff_seconds = params['backoff_seconds']
@@ -1144,7 +1163,71 @@ def _write_json_blob(encoded_value):
   return files.blobstore.get_blob_key(file_name)
 
 
-def _dereference_args(pipeline_name, args, kwargs):
+def _store_json(encoded_value):
+  """Decides how to save a JSON encoded value.
+
+  Small values are saved as text. Bigger ones are compressed, and only
+  values too big for an entity even then are written to a Blobstore File.
+
+  Args:
+    encoded_value: The encoded JSON string.
+
+  Returns:
+    Tuple (text, compressed, blob_key), exactly one of which is not None:
+      text: The value as a db.Text.
+      compressed: The zlib compressed value as a db.Blob.
+      blob_key: The blobstore.BlobKey for the file the value was written to.
+  """
+  if len(encoded_value) <= _MIN_COMPRESSED_JSON_SIZE:
+    return db.Text(encoded_value), None, None
+
+  compressed = zlib.compress(encoded_value, _JSON_COMPRESSION_LEVEL)
+  if len(compressed) <= _MAX_JSON_SIZE:
+    return None, db.Blob(compressed), None
+
+  # The encoded value is too big. Save it as a blob.
+  return None, None, _write_json_blob(encoded_value)
+
+
+def _get_arg_slot_keys(args, kwargs):
+  """Returns the set of db.Keys of the slots a Pipeline's arguments refer to.
+
+  Args:
+    args: Iterable of positional arguments, as for _dereference_args.
+    kwargs: Dictionary of keyword arguments, as for _dereference_args.
+  """
+  slot_keys = set()
+  for arg in itertools.chain(args, kwargs.itervalues()):
+    if arg['type'] == 'slot':
+      slot_keys.add(db.Key(arg['slot_key']))
+  return slot_keys
+
+
+def _get_slot_records(slot_keys, slot_records=None):
+  """Fetches _SlotRecords in one batch, skipping any fetched before.
+
+  Args:
+    slot_keys: Iterable of db.Key instances of _SlotRecords.
+    slot_records: Optional. Dictionary of _SlotRecords already fetched, as
+      returned by an earlier call.
+
+  Returns:
+    Dictionary mapping each db.Key in slot_keys to its _SlotRecord, or to
+    None if the record does not exist.
+  """
+  result = {}
+  missing_keys = []
+  for key in slot_keys:
+    if slot_records is not None and key in slot_records:
+      result[key] = slot_records[key]
+    else:
+      missing_keys.append(key)
+  if missing_keys:
+    result.update(zip(missing_keys, db.get(missing_keys)))
+  return result
+
+
+def _dereference_args(pipeline_name, args, kwargs, slot_records=None):
   """Dereference a Pipeline's arguments that are slots, validating them.
 
   Each argument value passed in is assumed to be a dictionary with the format:
@@ -1155,6 +1238,8 @@ def _dereference_args(pipeline_name, args, kwargs):
     pipeline_name: The name of the pipeline class; used for debugging.
     args: Iterable of positional arguments.
     kwargs: Dictionary of keyword arguments.
+    slot_records: Optional. Dictionary of _SlotRecords already fetched, as
+      returned by _get_slot_records.
 
   Returns:
     Tuple (args, kwargs) where:
@@ -1166,13 +1251,11 @@ def _dereference_args(pipeline_name, args, kwargs):
     present in the Datastore or have not yet been filled.
     UnexpectedPipelineError if an unknown parameter type was passed.
   """
-  lookup_slots = set()
-  for arg in itertools.chain(args, kwargs.itervalues()):
-    if arg['type'] == 'slot':
-      lookup_slots.add(db.Key(arg['slot_key']))
+  lookup_slots = _get_arg_slot_keys(args, kwargs)
 
   slot_dict = {}
-  for key, slot_record in zip(lookup_slots, db.get(lookup_slots)):
+  for key, slot_record in _get_slot_records(
+      lookup_slots, slot_records).iteritems():
     if slot_record is None or slot_record.status != _SlotRecord.FILLED:
       raise SlotNotFilledError(
           'Slot "%s" missing its value. From %s(*args=%s, **kwargs=%s)' %
@@ -1214,7 +1297,8 @@ def _generate_args(pipeline, future, queue_name, base_path):
     base_path: Relative URL for pipeline URL handlers.
 
   Returns:
-    Tuple (dependent_slots, output_slot_keys, params_text, params_blob) where:
+    Tuple (dependent_slots, output_slot_keys, params_text, params_compressed,
+    params_blob) where:
       dependent_slots: List of db.Key instances of _SlotRecords on which
         this pipeline will need to block before execution (passed to
         create a _BarrierRecord for running the pipeline).
@@ -1223,7 +1307,10 @@ def _generate_args(pipeline, future, queue_name, base_path):
         a _BarrierRecord for finalizing the pipeline).
       params_text: JSON dictionary of pipeline parameters to be serialized and
         saved in a corresponding _PipelineRecord. Will be None if the params are
-        too big and must be saved in a blob instead.
+        big enough to be compressed or saved in a blob instead.
+      params_compressed: The same, compressed, to be saved in the
+        _PipelineRecord. Will be None unless the params are big, but fit in the
+        entity once compressed.
       params_blob: JSON dictionary of pipeline parameters to be serialized and
         saved in a Blob file, and then attached to a _PipelineRecord. Will be
         None if the params data size was small enough to fit in the entity.
@@ -1277,14 +1364,10 @@ def _generate_args(pipeline, future, queue_name, base_path):
     output_slots[name] = str(slot.key)
 
   params_encoded = simplejson.dumps(params)
-  params_text = None
-  params_blob = None
-  if len(params_encoded) > _MAX_JSON_SIZE:
-    params_blob = _write_json_blob(params_encoded)
-  else:
-    params_text = params_encoded
+  params_text, params_compressed, params_blob = _store_json(params_encoded)
 
-  return dependent_slots, output_slot_keys, params_text, params_blob
+  return (dependent_slots, output_slot_keys, params_text, params_compressed,
+          params_blob)
 
 
 class _PipelineContext(object):
@@ -1345,13 +1428,7 @@ class _PipelineContext(object):
       slot._set_value_test(filler_pipeline_key, value)
     else:
       encoded_value = simplejson.dumps(value, sort_keys=True)
-      value_text = None
-      value_blob = None
-      if len(encoded_value) <= _MAX_JSON_SIZE:
-        value_text = db.Text(encoded_value)
-      else:
-        # The encoded value is too big. Save it as a blob.
-        value_blob = _write_json_blob(encoded_value)
+      value_text, value_compressed, value_blob = _store_json(encoded_value)
 
       def txn():
         slot_record = db.get(slot.key)
@@ -1367,6 +1444,7 @@ class _PipelineContext(object):
         # of these up-stream pipelines.
         slot_record.filler = filler_pipeline_key
         slot_record.value_text = value_text
+        slot_record.value_compressed = value_compressed
         slot_record.value_blob = value_blob
         slot_record.status = _SlotRecord.FILLED
         slot_record.fill_time = self._gettime()
@@ -1612,8 +1690,9 @@ class _PipelineContext(object):
       slot.key = db.Key.from_path(
           *slot.key.to_path(), **dict(parent=pipeline._pipeline_key))
 
-    _, output_slots, params_text, params_blob = _generate_args(
-        pipeline, pipeline.outputs, self.queue_name, self.base_path)
+    _, output_slots, params_text, params_compressed, params_blob = (
+        _generate_args(
+            pipeline, pipeline.outputs, self.queue_name, self.base_path))
 
     def txn():
       pipeline_record = db.get(pipeline._pipeline_key)
@@ -1636,6 +1715,7 @@ class _PipelineContext(object):
           # Bug in DB means we need to use the storage name here,
           # not the local property name.
           params=params_text,
+          params_compressed=params_compressed,
           params_blob=params_blob,
           start_time=self._gettime(),
           class_path=pipeline._class_path,
@@ -2072,7 +2152,8 @@ class _PipelineContext(object):
     all_output_slots = set()
     for sub_stage in sub_stage_ordering:
       future = sub_stage_dict[sub_stage]
-      dependent_slots, output_slots, params_text, params_blob = _generate_args(
+      (dependent_slots, output_slots, params_text, params_compressed,
+       params_blob) = _generate_args(
           sub_stage, future, self.queue_name, self.base_path)
       child_pipeline_key = db.Key.from_path(
           _PipelineRecord.kind(), uuid.uuid1().hex)
@@ -2085,6 +2166,7 @@ class _PipelineContext(object):
           # Bug in DB means we need to use the storage name here,
           # not the local property name.
           params=params_text,
+          params_compressed=params_compressed,
           params_blob=params_blob,
           class_path=sub_stage._class_path,
           max_attempts=sub_stage.max_attempts)
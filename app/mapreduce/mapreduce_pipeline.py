@@ -85,7 +85,12 @@ class MapPipeline(base_handler.PipelineBase):
 
 
 class _ReducerReader(input_readers.RecordsReader):
-  """Reader to read KeyValues records files from Files API."""
+  """Reader to read KeyValues records files from Files API.
+
+  If the "combined_values" mapper parameter is set, the values in the files
+  were already combined during the shuffle, and are passed to the combiner
+  as previously combined values.
+  """
 
   expand_parameters = True
 
@@ -97,11 +102,14 @@ class _ReducerReader(input_readers.RecordsReader):
   def __iter__(self):
     ctx = context.get()
     combiner = None
+    combined_values = False
 
     if ctx:
       combiner_spec = ctx.mapreduce_spec.mapper.params.get("combiner_spec")
       if combiner_spec:
         combiner = util.handler_for_name(combiner_spec)
+        combined_values = ctx.mapreduce_spec.mapper.params.get(
+            "combined_values", False)
 
     self.current_key = None
     self.current_values = None
@@ -119,8 +127,15 @@ class _ReducerReader(input_readers.RecordsReader):
             (self.current_key, proto.key()))
 
       if combiner:
-        combiner_result = combiner(
-            self.current_key, proto.value_list(), self.current_values)
+        if combined_values:
+          # Values were combined during the shuffle.
+          combiner_result = combiner(
+              self.current_key, [],
+              self.current_values +
+              shuffler._decode_combined(proto.value_list()))
+        else:
+          combiner_result = combiner(
+              self.current_key, proto.value_list(), self.current_values)
 
         if not util.is_generator(combiner_result):
           raise errors.BadCombinerOutputError(
@@ -193,6 +208,10 @@ class ReducePipeline(base_handler.PipelineBase):
       combined values that might be processed by another combiner call, but will
       eventually end up in reducer. The combiner output key is assumed to be the
       same as the input key.
+    combined_values: Optional. True if the files were shuffled by
+      ShufflePipeline with the same combiner_spec, so that their values are
+      already combined: they are passed to the combiner as previously
+      combined results rather than as values.
 
   Returns:
     filenames from output writer.
@@ -204,7 +223,8 @@ class ReducePipeline(base_handler.PipelineBase):
           output_writer_spec,
           params,
           filenames,
-          combiner_spec=None):
+          combiner_spec=None,
+          combined_values=False):
     new_params = dict(params or {})
     new_params.update({
         "files": filenames
@@ -212,6 +232,7 @@ class ReducePipeline(base_handler.PipelineBase):
     if combiner_spec:
       new_params.update({
           "combiner_spec": combiner_spec,
+          "combined_values": combined_values,
           })
 
     yield mapper_pipeline.MapperPipeline(
@@ -239,7 +260,15 @@ class MapreducePipeline(base_handler.PipelineBase):
       key, list of values and list of previously combined results. It yields
       combined values that might be processed by another combiner call, but will
       eventually end up in reducer. The combiner output key is assumed to be the
-      same as the input key.
+      same as the input key. The combiner also runs during the shuffle: first
+      on buffered map output, with an empty list of previously combined
+      results, then while merging, with an empty list of values and the
+      results of earlier calls as previously combined results. Its results
+      are stored as JSON in between, so they must be JSON serializable, and
+      come back as JSON types (lists instead of tuples, unicode strings).
+    hot_key_splits: Optional. With a combiner, split keys too common to be
+      reduced in one shard over this many files during the shuffle, as for
+      ShufflePipeline.
 
   Returns:
     filenames from output writer.
@@ -254,21 +283,24 @@ class MapreducePipeline(base_handler.PipelineBase):
           mapper_params=None,
           reducer_params=None,
           shards=None,
-          combiner_spec=None):
+          combiner_spec=None,
+          hot_key_splits=None):
     map_pipeline = yield MapPipeline(job_name,
                                      mapper_spec,
                                      input_reader_spec,
                                      params=mapper_params,
                                      shards=shards)
     shuffler_pipeline = yield ShufflePipeline(
-        job_name, map_pipeline)
+        job_name, map_pipeline, combiner_spec=combiner_spec,
+        hot_key_splits=hot_key_splits)
     reducer_pipeline = yield ReducePipeline(
         job_name,
         reducer_spec,
         output_writer_spec,
         reducer_params,
         shuffler_pipeline,
-        combiner_spec=combiner_spec)
+        combiner_spec=combiner_spec,
+        combined_values=bool(combiner_spec))
     with pipeline.After(reducer_pipeline):
       all_temp_files = yield pipeline_common.Extend(
           map_pipeline, shuffler_pipeline)
@@ -25,12 +25,18 @@ __all__ = [
     "ShufflePipeline",
     ]
 
+import base64
 import gc
 import heapq
 import logging
 import os
 import time
 
+try:
+  import json as simplejson
+except ImportError:
+  from mapreduce.lib import simplejson
+
 from mapreduce.lib import pipeline
 from mapreduce.lib.pipeline import common as pipeline_common
 from mapreduce.lib import files
@@ -44,6 +50,7 @@ from mapreduce import input_readers
 from mapreduce import mapper_pipeline
 from mapreduce import operation
 from mapreduce import output_writers
+from mapreduce import util
 
 
 class _OutputFile(db.Model):
@@ -70,9 +77,192 @@ class _OutputFile(db.Model):
     return db.Key.from_path(cls.kind(), job_id)
 
 
-def _compare_keys(key_record1, key_record2):
-  """Compare two (key, records) protos by key."""
-  return cmp(key_record1[0], key_record2[0])
+def _read_prefixed_string(record, pos, tag):
+  """Read a length-prefixed string field at a position in a serialized proto.
+
+  Args:
+    record: a serialized proto.
+    pos: the position of the field's tag in record.
+    tag: the field's expected (single byte) tag.
+
+  Returns:
+    (value, end) tuple, where end is the position after the field, or None if
+    record doesn't contain such a field at pos.
+  """
+  try:
+    if record[pos] != tag:
+      return None
+    length = ord(record[pos + 1])
+    pos += 2
+    if length >= 0x80:
+      length &= 0x7f
+      shift = 7
+      while True:
+        b = ord(record[pos])
+        pos += 1
+        length |= (b & 0x7f) << shift
+        if b < 0x80:
+          break
+        shift += 7
+  except IndexError:
+    return None
+  end = pos + length
+  if end > len(record):
+    return None
+  return (record[pos:end], end)
+
+
+def _record_key(record):
+  """Extract the key of a serialized KeyValue proto.
+
+  KeyValue.Encode() writes the key first, as field 1 (tag byte 0x0a) with a
+  varint length prefix, so the key can be sliced out without parsing the
+  rest of the record. Anything else is parsed in full.
+
+  Args:
+    record: a serialized KeyValue proto.
+
+  Returns:
+    the key as string.
+  """
+  key = _read_prefixed_string(record, 0, "\x0a")
+  if key is not None:
+    return key[0]
+
+  proto = file_service_pb.KeyValue()
+  proto.ParseFromString(record)
+  return proto.key()
+
+
+def _record_key_value(record):
+  """Extract the key and value of a serialized KeyValue proto.
+
+  Like _record_key, falls back to parsing the proto in full if it isn't
+  laid out as KeyValue.Encode() writes it (key, then value).
+
+  Args:
+    record: a serialized KeyValue proto.
+
+  Returns:
+    (key, value) tuple.
+  """
+  key = _read_prefixed_string(record, 0, "\x0a")
+  if key is not None:
+    value = _read_prefixed_string(record, key[1], "\x12")
+    if value is not None and value[1] == len(record):
+      return (key[0], value[0])
+
+  proto = file_service_pb.KeyValue()
+  proto.ParseFromString(record)
+  return (proto.key(), proto.value())
+
+
+# Combiner handlers by combiner spec.
+_combiners = {}
+
+
+def _get_combiner(ctx):
+  """Get the combiner of the current job.
+
+  Args:
+    ctx: mapreduce context as context.Context.
+
+  Returns:
+    the combiner function named by the "combiner_spec" mapper parameter, or
+    None if there isn't one.
+  """
+  if ctx is None:
+    return None
+  combiner_spec = ctx.mapreduce_spec.mapper.params.get("combiner_spec")
+  if not combiner_spec:
+    return None
+  if combiner_spec not in _combiners:
+    _combiners[combiner_spec] = util.handler_for_name(combiner_spec)
+  return _combiners[combiner_spec]
+
+
+def _combine(combiner, key, values, combiner_values, ctx):
+  """Run a combiner over values of a key while they are shuffled.
+
+  Args:
+    combiner: combiner function, as for MapreducePipeline.
+    key: values key.
+    values: list of values from the mapper.
+    combiner_values: list of values previously yielded by the combiner.
+    ctx: mapreduce context as context.Context.
+
+  Returns:
+    list of combined values, encoded with _encode_combined.
+  """
+  combiner_result = combiner(key, values, combiner_values)
+  if not util.is_generator(combiner_result):
+    raise errors.BadCombinerOutputError(
+        "Combiner %s should yield values instead of returning them (%s)" %
+        (combiner, combiner_result))
+
+  combined_values = []
+  for value in combiner_result:
+    if isinstance(value, operation.Operation):
+      value(ctx)
+    else:
+      combined_values.append(value)
+  return _encode_combined(combiner, combined_values)
+
+
+def _encode_combined(combiner, combiner_values):
+  """Encode values yielded by a combiner to be written to shuffle files.
+
+  Once a job has a combiner, every value in its shuffle files comes from the
+  combiner, and is stored as JSON so that it keeps its type (as much as JSON
+  allows; _ReducerReader saves them as JSON between slices anyway).
+
+  Args:
+    combiner: combiner function, for error messages.
+    combiner_values: list of values yielded by the combiner.
+
+  Returns:
+    list of JSON encoded values.
+
+  Raises:
+    BadCombinerOutputError: if a value can't be encoded as JSON.
+  """
+  try:
+    return [simplejson.dumps(value) for value in combiner_values]
+  except (TypeError, ValueError), e:
+    raise errors.BadCombinerOutputError(
+        "Combiner %s should yield JSON serializable values (%s)" %
+        (combiner, e))
+
+
+def _decode_combined(values):
+  """Decode combined values read from shuffle files.
+
+  Args:
+    values: list of values encoded with _encode_combined.
+
+  Returns:
+    list of values as yielded by the combiner.
+  """
+  return [simplejson.loads(value) for value in values]
+
+
+def _get_hot_keys(ctx):
+  """Get the hot keys of the current hash job.
+
+  Args:
+    ctx: mapreduce context as context.Context.
+
+  Returns:
+    (hot_keys, hot_key_splits) tuple: a dict mapping the keys named by the
+    "hot_keys" mapper parameter to their index in it, and the
+    "hot_key_splits" mapper parameter.
+  """
+  params = ctx.mapreduce_spec.mapper.params
+  hot_keys = params.get("hot_keys")
+  if not hot_keys:
+    return ({}, 0)
+  return (dict((base64.b64decode(key), i) for (i, key) in enumerate(hot_keys)),
+          params.get("hot_key_splits") or 1)
 
 
 class _BatchRecordsReader(input_readers.RecordsReader):
@@ -100,25 +290,19 @@ class _BatchRecordsReader(input_readers.RecordsReader):
 def _sort_records_map(records):
   """Map function sorting records.
 
-  Converts records to KeyValue protos, sorts them by key and writes them
-  into new blobstore file. Creates _OutputFile entity to record resulting
-  file name.
+  Sorts serialized KeyValue protos by key (extracted without parsing the
+  whole proto) and writes them into new blobstore file. Creates _OutputFile
+  entity to record resulting file name.
 
   Args:
-    records: list of records which are serialized KeyValue protos.
+    records: list of records which are serialized KeyValue protos. The list
+      is sorted in place and emptied as it is written out.
   """
   ctx = context.get()
-  l = len(records)
-  key_records = [None] * l
-
-  logging.debug("Parsing")
-  for i in range(l):
-    proto = file_service_pb.KeyValue()
-    proto.ParseFromString(records[i])
-    key_records[i] = (proto.key(), records[i])
 
   logging.debug("Sorting")
-  key_records.sort(cmp=_compare_keys)
+  # A stable sort by key, so records with equal keys keep their order.
+  records.sort(key=_record_key)
 
   logging.debug("Writing")
   blob_file_name = (ctx.mapreduce_spec.name + "-" +
@@ -126,8 +310,11 @@ def _sort_records_map(records):
   output_path = files.blobstore.create(
       _blobinfo_uploaded_filename=blob_file_name)
   with output_writers.RecordsPool(output_path, ctx=ctx) as pool:
-    for key_record in key_records:
-      pool.append(key_record[1])
+    for i in xrange(len(records)):
+      pool.append(records[i])
+      # Let written records be freed while the rest are written.
+      records[i] = None
+  del records[:]
 
   logging.debug("Finalizing")
   files.finalize(output_path)
@@ -223,6 +410,15 @@ class _MergingReader(input_readers.InputReader):
   MAX_VALUES_COUNT_PARAM = "max_values_count"
   MAX_VALUES_SIZE_PARAM = "max_values_size"
 
+  # Total read buffer size to share among the files of a shard, and the
+  # bounds on each file's buffer.
+  _BUFFER_BUDGET = 16 * 1024 * 1024
+  _MIN_BUFFER_SIZE = 512 * 1024
+  _MAX_BUFFER_SIZE = 4 * 1024 * 1024
+
+  # How many records to read between counter updates.
+  _COUNTER_BATCH = 1000
+
   def __init__(self,
                offsets,
                max_values_count,
@@ -257,12 +453,40 @@ class _MergingReader(input_readers.InputReader):
     readers = []
 
     # Initialize heap
+    buffer_size = max(self._MIN_BUFFER_SIZE,
+                      min(self._MAX_BUFFER_SIZE,
+                          self._BUFFER_BUDGET // max(len(filenames), 1)))
     for (i, filename) in enumerate(filenames):
       offset = self._offsets[i]
-      reader = records.RecordsReader(files.BufferedFile(filename))
+      reader = records.RecordsReader(
+          files.BufferedFile(filename, buffer_size=buffer_size))
       reader.seek(offset)
       readers.append((None, None, i, reader))
 
+    # Counter updates are batched, and flushed however iteration ends.
+    self._read_bytes = 0
+    self._read_msec = 0.0
+    self._read_records = 0
+    try:
+      for result in self._merge(readers):
+        yield result
+    finally:
+      self._flush_counters()
+
+  def _flush_counters(self):
+    """Add batched counter updates to the current context."""
+    ctx = context.get()
+    if ctx and self._read_records:
+      operation.counters.Increment(
+          input_readers.COUNTER_IO_READ_BYTES, self._read_bytes)(ctx)
+      operation.counters.Increment(
+          input_readers.COUNTER_IO_READ_MSEC, int(self._read_msec))(ctx)
+    self._read_bytes = 0
+    self._read_msec = 0.0
+    self._read_records = 0
+
+  def _merge(self, readers):
+    """Merge records from a heap of readers, grouping values by key."""
     # Read records from heap and merge values with the same key.
 
     # current_result is yielded and consumed buy _merge_map.
@@ -308,18 +532,14 @@ class _MergingReader(input_readers.InputReader):
         start_time = time.time()
         binary_record = reader.read()
         # update counters
-        if context.get():
-          operation.counters.Increment(
-              input_readers.COUNTER_IO_READ_BYTES,
-              len(binary_record))(context.get())
-          operation.counters.Increment(
-              input_readers.COUNTER_IO_READ_MSEC,
-              int((time.time() - start_time) * 1000))(context.get())
-        proto = file_service_pb.KeyValue()
-        proto.ParseFromString(binary_record)
+        self._read_bytes += len(binary_record)
+        self._read_msec += (time.time() - start_time) * 1000
+        self._read_records += 1
+        if self._read_records >= self._COUNTER_BATCH:
+          self._flush_counters()
+        (key, value) = _record_key_value(binary_record)
         # Put read data back into heap.
-        heapq.heapreplace(readers,
-                          (proto.key(), proto.value(), index, reader))
+        heapq.heapreplace(readers, (key, value, index, reader))
       except EOFError:
         heapq.heappop(readers)
 
@@ -364,8 +584,16 @@ class _HashingBlobstoreOutputWriter(output_writers.BlobstoreOutputWriterBase):
 
   The output is tailored towards shuffler needs. It shards key/values using
   key hash modulo number of output files.
+
+  If the "hot_keys" mapper parameter names keys that are too common to be
+  reduced in one shard, "hot_key_splits" extra output files are created after
+  the regular ones, and the values of hot keys are spread over them instead,
+  to be re-aggregated by _ReaggregateHotKeysPipeline.
   """
 
+  # True if the values written are already combined.
+  _COMBINED_INPUT = False
+
   def __init__(self, filenames):
     """Constructor.
 
@@ -373,6 +601,10 @@ class _HashingBlobstoreOutputWriter(output_writers.BlobstoreOutputWriterBase):
       filenames: list of filenames that this writer outputs to.
     """
     self._filenames = filenames
+    # Loaded from the mapper parameters on first write.
+    self._hot_keys = None
+    self._hot_key_files = 0
+    self._hot_key_writes = 0
 
   @classmethod
   def validate(cls, mapper_spec):
@@ -392,18 +624,32 @@ class _HashingBlobstoreOutputWriter(output_writers.BlobstoreOutputWriterBase):
       mapreduce_state: an instance of model.MapreduceState describing current
       job. State can be modified during initialization.
     """
-    shards = mapreduce_state.mapreduce_spec.mapper.shard_count
-
     filenames = []
-    for i in range(shards):
+    for name in cls._get_output_names(mapreduce_state.mapreduce_spec.mapper):
       blob_file_name = (mapreduce_state.mapreduce_spec.name +
                         "-" + mapreduce_state.mapreduce_spec.mapreduce_id +
-                        "-output-" + str(i))
+                        name)
       filenames.append(
           files.blobstore.create(
               _blobinfo_uploaded_filename=blob_file_name))
     mapreduce_state.writer_state = {"filenames": filenames}
 
+  @classmethod
+  def _get_output_names(cls, mapper_spec):
+    """Get the suffixes of the names of the output files.
+
+    Args:
+      mapper_spec: an instance of model.MapperSpec.
+
+    Returns:
+      list of strings, one per output file.
+    """
+    hot_key_files = 0
+    if mapper_spec.params.get("hot_keys"):
+      hot_key_files = mapper_spec.params.get("hot_key_splits") or 1
+    return (["-output-" + str(i) for i in range(mapper_spec.shard_count)] +
+            ["-output-hot-" + str(i) for i in range(hot_key_files)])
+
   @classmethod
   def finalize_job(cls, mapreduce_state):
     """Finalize job-level writer state.
@@ -482,17 +728,135 @@ class _HashingBlobstoreOutputWriter(output_writers.BlobstoreOutputWriterBase):
       logging.error("Expecting a tuple, but got %s: %s",
                     data.__class__.__name__, data)
 
-    file_index = key.__hash__() % len(self._filenames)
+    if self._hot_keys is None:
+      (self._hot_keys, self._hot_key_files) = _get_hot_keys(ctx)
+
+    file_index = self._get_file_index(key)
     pool_name = "kv_pool%d" % file_index
     filename = self._filenames[file_index]
 
-    if ctx.get_pool(pool_name) is None:
-      ctx.register_pool(pool_name,
-                        output_writers.RecordsPool(filename=filename, ctx=ctx))
-    proto = file_service_pb.KeyValue()
-    proto.set_key(key)
-    proto.set_value(value)
-    ctx.get_pool(pool_name).append(proto.Encode())
+    pool = ctx.get_pool(pool_name)
+    if pool is None:
+      pool = output_writers.RecordsPool(filename=filename, ctx=ctx)
+      combiner = _get_combiner(ctx)
+      if combiner:
+        pool = _CombiningPool(pool, combiner, ctx,
+                              combined_input=self._COMBINED_INPUT)
+      ctx.register_pool(pool_name, pool)
+
+    if isinstance(pool, _CombiningPool):
+      pool.append(key, value)
+    else:
+      proto = file_service_pb.KeyValue()
+      proto.set_key(key)
+      proto.set_value(value)
+      pool.append(proto.Encode())
+
+  def _get_file_index(self, key):
+    """Get the index of the file to write a key's value to.
+
+    Args:
+      key: key as string.
+
+    Returns:
+      index in self._filenames.
+    """
+    regular_files = len(self._filenames) - self._hot_key_files
+    if key in self._hot_keys:
+      # Round-robin, so that even identical values get spread out.
+      file_index = regular_files + (
+          (key.__hash__() + self._hot_key_writes) % self._hot_key_files)
+      self._hot_key_writes += 1
+      return file_index
+    return key.__hash__() % regular_files
+
+
+class _HotKeysOutputWriter(_HashingBlobstoreOutputWriter):
+  """An OutputWriter which re-aggregates the values of hot keys.
+
+  Takes values already combined by _HashingBlobstoreOutputWriter, combines
+  them again, and writes each hot key to a file of its own, or shares files
+  out in order of frequency if there are more hot keys than "hot_key_splits".
+  """
+
+  _COMBINED_INPUT = True
+
+  @classmethod
+  def _get_output_names(cls, mapper_spec):
+    """Get the suffixes of the names of the output files.
+
+    Args:
+      mapper_spec: an instance of model.MapperSpec.
+
+    Returns:
+      list of strings, one per output file.
+    """
+    params = mapper_spec.params
+    count = min(len(params["hot_keys"]), params.get("hot_key_splits") or 1)
+    return ["-output-hot-" + str(i) for i in range(count)]
+
+  def _get_file_index(self, key):
+    """Get the index of the file to write a key's value to.
+
+    Args:
+      key: key as string.
+
+    Returns:
+      index in self._filenames.
+    """
+    return self._hot_keys.get(key, key.__hash__()) % len(self._filenames)
+
+
+class _CombiningPool(object):
+  """Pool which buffers values by key, and combines them before appending
+  them to a RecordsPool as KeyValue protos.
+  """
+
+  # Approximate size of buffered keys and values to combine at once.
+  _FLUSH_SIZE = 1024 * 1024
+
+  def __init__(self, records_pool, combiner, ctx, combined_input=False):
+    """Constructor.
+
+    Args:
+      records_pool: output_writers.RecordsPool to write combined values to.
+      combiner: combiner function.
+      ctx: mapreduce context as context.Context.
+      combined_input: True if the values appended were already combined, and
+        are encoded with _encode_combined.
+    """
+    self._records_pool = records_pool
+    self._combiner = combiner
+    self._ctx = ctx
+    self._combined_input = combined_input
+    self._values = {}
+    self._size = 0
+
+  def append(self, key, value):
+    """Append a key/value pair."""
+    self._values.setdefault(key, []).append(value)
+    self._size += len(key) + len(value)
+    if self._size > self._FLUSH_SIZE:
+      self.flush()
+
+  def flush(self):
+    """Combine buffered values and flush them to the records pool."""
+    for key in sorted(self._values):
+      if self._combined_input:
+        combined_values = _combine(self._combiner, key, [],
+                                   _decode_combined(self._values[key]),
+                                   self._ctx)
+      else:
+        combined_values = _combine(self._combiner, key, self._values[key], [],
+                                   self._ctx)
+      for value in combined_values:
+        proto = file_service_pb.KeyValue()
+        proto.set_key(key)
+        proto.set_value(value)
+        self._records_pool.append(proto.Encode())
+    self._values = {}
+    self._size = 0
+    self._records_pool.flush()
 
 
 class _ShardOutputs(base_handler.PipelineBase):
@@ -511,12 +875,19 @@ def _merge_map(key, values, partial):
   """A map function used in merge phase.
 
   Stores (key, values) into KeyValues proto and yields its serialization.
+  If the job has a combiner, values are combiner values, and are combined
+  again first.
 
   Args:
     key: values key.
     values: values themselves.
     partial: True if more values for this key will follow. False otherwise.
   """
+  ctx = context.get()
+  combiner = _get_combiner(ctx)
+  if combiner:
+    values = _combine(combiner, key, [], _decode_combined(values), ctx)
+
   proto = file_service_pb.KeyValues()
   proto.set_key(key)
   proto.value_list().extend(values)
@@ -524,15 +895,70 @@ def _merge_map(key, values, partial):
   yield proto.Encode()
 
 
+def _merge_chunks_map(key, values, partial):
+  """A map function used in intermediate merge passes.
+
+  Writes merged (and combined, if the job has a combiner) values back out as
+  KeyValue protos, in key order, so that the next pass can merge the
+  resulting files.
+
+  Args:
+    key: values key.
+    values: values themselves.
+    partial: True if more values for this key will follow. False otherwise.
+  """
+  ctx = context.get()
+  combiner = _get_combiner(ctx)
+  if combiner:
+    values = _combine(combiner, key, [], _decode_combined(values), ctx)
+
+  for value in values:
+    proto = file_service_pb.KeyValue()
+    proto.set_key(key)
+    proto.set_value(value)
+    yield proto.Encode()
+
+
+class _RegroupFiles(base_handler.PipelineBase):
+  """Splits a flat list of filenames into consecutive lists.
+
+  Args:
+    filenames: list of filenames.
+    counts: list of ints, the length of each resulting list. A count of 0
+      takes the list from original_filenames instead.
+    original_filenames: list of lists of filenames, one per count.
+
+  Returns:
+    list of lists of filenames.
+  """
+
+  def run(self, filenames, counts, original_filenames):
+    result = []
+    start = 0
+    for count, original in zip(counts, original_filenames):
+      if not count:
+        result.append(original)
+        continue
+      result.append(filenames[start:start + count])
+      start += count
+    return result
+
+
 class _MergePipeline(base_handler.PipelineBase):
   """Pipeline to merge sorted chunks.
 
   This pipeline merges together individually sorted chunks of each shard.
+  A shard with more than _MAX_FAN_IN chunks first has groups of its chunks
+  merged into intermediate files, in as many passes as it takes, so that
+  no reader has more than _MAX_FAN_IN files open at once. Shards within the
+  limit wait for those passes but are not rewritten.
 
   Args:
     filenames: list of lists of filenames. Each list will correspond to a single
       shard. Each file in the list should have keys sorted and should contain
       records with KeyValue serialized entity.
+    combiner_spec: Optional. Specification of a combine function to run on
+      merged values, as for MapreducePipeline.
 
   Returns:
     The list of filenames, where each filename is fully merged and will contain
@@ -543,22 +969,121 @@ class _MergePipeline(base_handler.PipelineBase):
   _MAX_VALUES_COUNT = 100000  # Combiners usually good for 5 orders of magnitude
   # Maximum size of values to produce in a single KeyValues proto.
   _MAX_VALUES_SIZE = 1000000
+  # Maximum number of files to merge at once.
+  _MAX_FAN_IN = 32
+
+  def run(self, job_name, filenames, combiner_spec=None):
+    combiner_params = {}
+    if combiner_spec:
+      combiner_params["combiner_spec"] = combiner_spec
+
+    if filenames and max(len(f) for f in filenames) > self._MAX_FAN_IN:
+      groups = []
+      group_counts = []
+      for shard_filenames in filenames:
+        if len(shard_filenames) <= self._MAX_FAN_IN:
+          group_counts.append(0)
+          continue
+        shard_groups = [shard_filenames[i:i + self._MAX_FAN_IN] for i in
+                        range(0, len(shard_filenames), self._MAX_FAN_IN)]
+        groups.extend(shard_groups)
+        group_counts.append(len(shard_groups))
+
+      merged_groups = yield mapper_pipeline.MapperPipeline(
+          job_name + "-shuffle-merge-pass",
+          __name__ + "._merge_chunks_map",
+          __name__ + "._MergingReader",
+          output_writer_spec=
+          output_writers.__name__ + ".BlobstoreRecordsOutputWriter",
+          params=dict(combiner_params, **{
+            _MergingReader.FILES_PARAM: groups,
+            output_writers.BlobstoreOutputWriterBase.OUTPUT_SHARDING_PARAM:
+            output_writers.BlobstoreOutputWriterBase.OUTPUT_SHARDING_INPUT_SHARDS,
+            }),
+          shards=len(groups))
+      regrouped = yield _RegroupFiles(merged_groups, group_counts, filenames)
+      merged_files = yield _MergePipeline(job_name, regrouped, combiner_spec)
+
+      with pipeline.After(merged_files):
+        yield mapper_pipeline._CleanupPipeline(merged_groups)
+
+      yield pipeline_common.Return(merged_files)
+      return
 
-  def run(self, job_name, filenames):
     yield mapper_pipeline.MapperPipeline(
         job_name + "-shuffle-merge",
         __name__ + "._merge_map",
         __name__ + "._MergingReader",
         output_writer_spec=
         output_writers.__name__ + ".BlobstoreRecordsOutputWriter",
-        params={
+        params=dict(combiner_params, **{
           _MergingReader.FILES_PARAM: filenames,
           _MergingReader.MAX_VALUES_COUNT_PARAM: self._MAX_VALUES_COUNT,
           _MergingReader.MAX_VALUES_SIZE_PARAM: self._MAX_VALUES_SIZE,
-          },
+          }),
         shards=len(filenames))
 
 
+class _SampleHotKeysPipeline(base_handler.PipelineBase):
+  """A pipeline to find keys too common to be reduced in a single shard.
+
+  Counts keys in records read from the start of up to _MAX_SAMPLE_FILES of
+  the mapper output files, _SAMPLE_SIZE records in all, so that the time it
+  takes doesn't grow with the size of the job.
+
+  Args:
+    filenames: filenames of mapper output. Should be of records format
+      with serialized KeyValue proto.
+    shards: number of shards the keys will be hashed into.
+
+  Returns:
+    The list of hot keys, base64 encoded, most common first. A key is hot if
+    it alone has more than _HOT_KEY_SHARE of a shard's share of the sample.
+  """
+
+  # Number of records to read, over all files.
+  _SAMPLE_SIZE = 50000
+  # Maximum number of files to read from.
+  _MAX_SAMPLE_FILES = 32
+  # Share of a shard's records a key must have alone to be hot.
+  _HOT_KEY_SHARE = 0.5
+  # Minimum number of sampled records of a hot key, so that small jobs are
+  # shuffled as usual.
+  _MIN_HOT_KEY_COUNT = 1000
+  # Maximum number of hot keys to split.
+  _MAX_HOT_KEYS = 100
+
+  def run(self, filenames, shards):
+    if not filenames:
+      return []
+    # Spread the sample over the files evenly.
+    step = -(-len(filenames) // self._MAX_SAMPLE_FILES)
+    sample_files = filenames[::step]
+    file_sample_size = self._SAMPLE_SIZE // len(sample_files)
+
+    counts = {}
+    total = 0
+    for filename in sample_files:
+      reader = records.RecordsReader(files.BufferedFile(filename))
+      for _ in xrange(file_sample_size):
+        try:
+          key = _record_key(reader.read())
+        except EOFError:
+          break
+        counts[key] = counts.get(key, 0) + 1
+        total += 1
+
+    min_count = max(self._MIN_HOT_KEY_COUNT,
+                    total * self._HOT_KEY_SHARE / shards)
+    hot_keys = sorted((key for (key, count) in counts.iteritems()
+                       if count >= min_count),
+                      key=lambda key: -counts[key])[:self._MAX_HOT_KEYS]
+    if hot_keys:
+      logging.info("Splitting %d hot keys out of %d sampled records",
+                   len(hot_keys), total)
+    return [base64.b64encode(key) for key in hot_keys]
+
+
 def _hashing_map(binary_record):
   """A map function used in hash phase.
 
@@ -569,6 +1094,43 @@ def _hashing_map(binary_record):
   yield (proto.key(), proto.value())
 
 
+class _ReaggregateHotKeysPipeline(base_handler.PipelineBase):
+  """A pipeline to combine the values of hot keys split by _HashPipeline.
+
+  Reads the hot key files in parallel, combines the values of each hot key
+  again, and writes them out so that each hot key has a file of its own (or
+  shares one, if there are more hot keys than hot_key_splits). The files can
+  then be sorted and merged like any other, and reduced in parallel.
+
+  Args:
+    job_name: root mapreduce job name.
+    filenames: the hot key files from _HashPipeline.
+    hot_keys: list of base64 encoded hot keys, most common first, as from
+      _SampleHotKeysPipeline.
+    hot_key_splits: maximum number of files to write.
+    combiner_spec: Specification of a combine function, as for
+      MapreducePipeline.
+
+  Returns:
+    The list of filenames. Each file is of records format with serialized
+    KeyValue protos with combined values.
+  """
+
+  def run(self, job_name, filenames, hot_keys, hot_key_splits, combiner_spec):
+    yield mapper_pipeline.MapperPipeline(
+        job_name + "-shuffle-hot-keys",
+        __name__ + "._hashing_map",
+        input_readers.__name__ + ".RecordsReader",
+        output_writer_spec=__name__ + "._HotKeysOutputWriter",
+        params={
+            "files": filenames,
+            "combiner_spec": combiner_spec,
+            "hot_keys": hot_keys,
+            "hot_key_splits": hot_key_splits,
+        },
+        shards=len(filenames))
+
+
 class _HashPipeline(base_handler.PipelineBase):
   """A pipeline to read mapper output and hash by key.
 
@@ -578,21 +1140,34 @@ class _HashPipeline(base_handler.PipelineBase):
       with serialized KeyValue proto.
     shards: Optional. Number of output shards to generate. Defaults
       to the number of input files.
+    combiner_spec: Optional. Specification of a combine function to run on
+      buffered values before they are written, as for MapreducePipeline.
+    hot_keys: Optional. List of base64 encoded keys whose values are spread
+      over hot_key_splits extra files, as from _SampleHotKeysPipeline.
+    hot_key_splits: Optional. Number of extra files for hot keys.
 
   Returns:
     The list of filenames. Each file is of records formad with serialized
     KeyValue proto. For each proto its output file is decided based on key
-    hash. Thus all equal keys would end up in the same file.
+    hash. Thus all equal keys would end up in the same file, except for hot
+    keys, which end up in the last hot_key_splits files.
   """
-  def run(self, job_name, filenames, shards=None):
+  def run(self, job_name, filenames, shards=None, combiner_spec=None,
+          hot_keys=None, hot_key_splits=None):
     if shards is None:
       shards = len(filenames)
+    params = {'files': filenames}
+    if combiner_spec:
+      params['combiner_spec'] = combiner_spec
+    if hot_keys:
+      params['hot_keys'] = hot_keys
+      params['hot_key_splits'] = hot_key_splits
     yield mapper_pipeline.MapperPipeline(
             job_name + "-shuffle-hash",
             __name__ + "._hashing_map",
             input_readers.__name__ + ".RecordsReader",
             output_writer_spec= __name__ + "._HashingBlobstoreOutputWriter",
-            params={'files': filenames},
+            params=params,
             shards=shards)
 
 
@@ -651,6 +1226,50 @@ class _ShuffleServicePipeline(base_handler.PipelineBase):
     return True
 
 
+class _SortAndMergePipeline(base_handler.PipelineBase):
+  """A pipeline to sort and merge hashed files.
+
+  Hot key files, if any, are re-aggregated by _ReaggregateHotKeysPipeline
+  first, and the resulting files are sorted and merged with the others.
+
+  Args:
+    job_name: root mapreduce job name.
+    filenames: list of filenames from _HashPipeline.
+    hot_keys: list of hot keys passed to _HashPipeline, maybe empty.
+    hot_key_splits: number of hot key files at the end of filenames, if
+      there are hot keys.
+    combiner_spec: Optional. Specification of a combine function, as for
+      MapreducePipeline.
+
+  Returns:
+    The list of merged filenames, as from _MergePipeline: one per regular
+    file, then one per file of hot keys.
+  """
+
+  def run(self, job_name, filenames, hot_keys, hot_key_splits,
+          combiner_spec=None):
+    temp_files = []
+    if hot_keys:
+      reaggregated_files = yield _ReaggregateHotKeysPipeline(
+          job_name, filenames[-hot_key_splits:], hot_keys, hot_key_splits,
+          combiner_spec)
+      temp_files.append(reaggregated_files)
+      filenames = yield pipeline_common.Extend(filenames[:-hot_key_splits],
+                                               reaggregated_files)
+
+    sorted_files = yield _SortChunksPipeline(job_name, filenames)
+    temp_files.append(sorted_files)
+
+    merged_files = yield _MergePipeline(job_name, sorted_files,
+                                        combiner_spec=combiner_spec)
+
+    with pipeline.After(merged_files):
+      all_temp_files = yield pipeline_common.Extend(*temp_files)
+      yield mapper_pipeline._CleanupPipeline(all_temp_files)
+
+    yield pipeline_common.Return(merged_files)
+
+
 class ShufflePipeline(base_handler.PipelineBase):
   """A pipeline to shuffle multiple key-value files.
 
@@ -661,24 +1280,44 @@ class ShufflePipeline(base_handler.PipelineBase):
       protocol messages.
     shards: Optional. Number of output shards to generate. Defaults
       to the number of input files.
+    combiner_spec: Optional. Specification of a combine function, as for
+      MapreducePipeline. If given, values are combined as they are hashed
+      and again as they are merged, so fewer of them are shuffled, and the
+      resulting files hold the JSON encoded values yielded by the combiner
+      instead of the mapper's values (see ReducePipeline's combined_values).
+      The shuffle service can't run combiners, so it isn't used then.
+    hot_key_splits: Optional. Only used with a combiner. If given, keys
+      common enough in a sample of the input to overload a shard are split
+      over this many files while they are hashed, then combined back
+      together in parallel, into up to this many extra output files (one per
+      hot key, as far as they go). Off by default.
 
   Returns:
     The list of filenames as string. Resulting files contain serialized
     file_service_pb.KeyValues protocol messages with all values collated
     to a single key.
   """
-  def run(self, job_name, filenames, shards=None):
-    if files.shuffler.available():
+  def run(self, job_name, filenames, shards=None, combiner_spec=None,
+          hot_key_splits=None):
+    if files.shuffler.available() and not combiner_spec:
       yield _ShuffleServicePipeline(job_name, filenames)
     else:
-      hashed_files = yield _HashPipeline(job_name, filenames, shards=shards)
-      sorted_files = yield _SortChunksPipeline(job_name, hashed_files)
-      temp_files = [hashed_files, sorted_files]
-
-      merged_files = yield _MergePipeline(job_name, sorted_files)
+      # Without a combiner, each key's values have to be reduced together,
+      # so they can't be split up.
+      hot_keys = []
+      if combiner_spec and hot_key_splits:
+        hot_keys = yield _SampleHotKeysPipeline(filenames,
+                                                shards or len(filenames))
+
+      hashed_files = yield _HashPipeline(job_name, filenames, shards=shards,
+                                         combiner_spec=combiner_spec,
+                                         hot_keys=hot_keys,
+                                         hot_key_splits=hot_key_splits)
+      merged_files = yield _SortAndMergePipeline(job_name, hashed_files,
+                                                 hot_keys, hot_key_splits,
+                                                 combiner_spec=combiner_spec)
 
       with pipeline.After(merged_files):
-        all_temp_files = yield pipeline_common.Extend(*temp_files)
-        yield mapper_pipeline._CleanupPipeline(all_temp_files)
+        yield mapper_pipeline._CleanupPipeline(hashed_files)
 
       yield pipeline_common.Return(merged_files)
@@ -3,11 +3,13 @@ __contributors__ = []
 
 from autocomplete_handler import AutocompleteName
 import cache
+import cache_purge
 
 import collections
 import csv
 import logging
 import json
+import re
 import urllib
 import webapp2
 
@@ -134,37 +136,27 @@ def add_autocomplete_results(name):
         entities.append(entity)
     check_entities(flush=True)
 
-class ClearCache(webapp2.RequestHandler):
+class ClearLegacyTileCache(webapp2.RequestHandler):
+    """Deletes tile cache entries keyed by the old full-URL hash scheme.
+
+    Tiles are now keyed by tile coordinates, query, style and data version 
+    (see tile_handler.canonical_tile_key), so entries named tile-<sha224> or 
+    utfgrid-<sha224> are never read again. They are deleted by a cache_purge 
+    job per prefix, which only matches the legacy names.
+    """
+    LEGACY_KEY = re.compile('^(tile|utfgrid)-[0-9a-f]{56}$')
+
     def get(self):
         self.error(405)
         self.response.headers['Allow'] = 'POST'
         return
 
     def post(self):
-        keys = []
-        key_count = 0
-        for key in cache.CacheItem.query().iter(keys_only=True):            
-            if key_count > 100:
-                try:
-                    ndb.delete_multi(keys)
-                    keys = []
-                    key_count = 0
-                except:
-                    logging.info('delete_multi retry')
-                    tries = 10
-                    while tries > 0:
-                        try:
-                            ndb.delete_multi(keys)
-                            keys = []
-                            key_count = 0
-                        except:
-                            logging.info('delete_multi retries left: %s' % tries)
-                            tries = tries - 1
-                    log.info('Failed to delete_multi on %s' % keys)
-            keys.append(key)
-        if len(keys) > 0:
-            ndb.delete_multi(keys)
-
+        for prefix in ['tile-', 'utfgrid-']:
+            mapreduce_id = cache_purge.start_purge(prefix=prefix, 
+                pattern=self.LEGACY_KEY.pattern)
+            logging.info('Started legacy %s cache purge job %s' % 
+                (prefix, mapreduce_id))
 
 class SearchCacheBuilder(webapp2.RequestHandler):
     def get(self):
@@ -392,7 +384,7 @@ class SearchResponseBuilder(webapp2.RequestHandler):
 
 application = webapp2.WSGIApplication(
     [('/backend/build_search_cache', SearchCacheBuilder),
-     ('/backend/clear_search_cache', ClearCache),
+     ('/backend/clear_legacy_tile_cache', ClearLegacyTileCache),
      ('/backend/build_autocomplete', AutoCompleteBuilder),
      ('/backend/build_search_response', SearchResponseBuilder),]
     , debug=True)
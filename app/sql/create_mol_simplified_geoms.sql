@@ -0,0 +1,53 @@
+-- create_mol_simplified_geoms()
+-- Function to build the multi-resolution geometry store used by get_tile(text, text, text, text, int).
+-- For every range table and checklist geometry table in data_registry, (re)creates a companion
+-- <table>_simplified table holding one simplified, grid-snapped copy of each geometry per zoom band.
+-- Zoom bands are 2, 4 and 6; a band's tolerance is one pixel at that zoom, so the copy is exact to
+-- a pixel for every tile zoom at or below it. Zooms above 6 are served from the full-resolution data.
+-- Run it again after loading new data.
+-- Returns:
+--	simplified_table: the name of the simplified table
+--	zoom_band: the zoom band
+--	feature_count: the number of geometries stored for the band
+
+DROP function create_mol_simplified_geoms();
+CREATE FUNCTION create_mol_simplified_geoms()
+	RETURNS TABLE(simplified_table text, zoom_band int, feature_count bigint)
+AS
+$$
+  DECLARE sql TEXT;
+  DECLARE data RECORD; -- a distinct source geometry table
+  DECLARE target TEXT;
+  DECLARE z INT;
+  DECLARE tolerance FLOAT;
+  BEGIN
+      FOR data in (
+          SELECT DISTINCT d.table_name as source_table, TEXT('cartodb_id') as id_field, d.geometry_field
+          FROM data_registry d WHERE d.type = 'range'
+          UNION
+          SELECT DISTINCT d.geom_table as source_table, d.geom_link_id as id_field, d.geometry_field
+          FROM data_registry d
+          WHERE d.type = 'geochecklist' or d.type = 'taxogeochecklist' or d.type = 'taxogeooccchecklist') LOOP
+          target = data.source_table || '_simplified';
+          EXECUTE 'DROP TABLE IF EXISTS ' || target;
+          -- Create an empty table so the id column keeps the type of the source key
+          EXECUTE 'CREATE TABLE ' || target || ' AS SELECT ' ||
+              data.id_field || ' as source_id, 0 as zoom_band, ' ||
+              data.geometry_field || ' as the_geom_webmercator ' ||
+              ' FROM ' || data.source_table || ' WHERE false';
+          FOREACH z IN ARRAY ARRAY[2, 4, 6] LOOP
+              -- Web mercator meters per pixel for a 256px tile at zoom z
+              tolerance = 156543.03392804097 / (2 ^ z);
+              sql = 'INSERT INTO ' || target || ' SELECT * FROM (SELECT ' ||
+                  data.id_field || ' as source_id, ' ||
+                  z || ' as zoom_band, ' ||
+                  ' ST_SnapToGrid(ST_SimplifyPreserveTopology(' || data.geometry_field || ', ' || tolerance || '), ' || tolerance || ') as the_geom_webmercator ' ||
+                  ' FROM ' || data.source_table || ') s ' ||
+                  ' WHERE s.the_geom_webmercator IS NOT NULL AND NOT ST_IsEmpty(s.the_geom_webmercator)';
+              EXECUTE sql;
+          END LOOP;
+          EXECUTE 'CREATE INDEX ' || target || '_band_id_btree ON ' || target || '(zoom_band, source_id)';
+          RETURN QUERY EXECUTE 'SELECT TEXT(''' || target || '''), zoom_band, count(*) FROM ' || target || ' GROUP BY zoom_band ORDER BY zoom_band';
+       END LOOP;
+    END
+$$  language plpgsql;
@@ -72,3 +72,97 @@ $$
     END
 
 $$  language plpgsql;
+
+--get_tile(text, text, text, text, int)
+-- Zoom-aware variant of get_tile(text, text, text, text). Range and checklist geometries are read
+-- from the <table>_simplified copies built by create_mol_simplified_geoms() for the zoom band that
+-- covers the tile zoom, falling back to the full-resolution geometry when no copy exists.
+-- Params:
+--	provider, type, scientificname, table_name: as for get_tile(text, text, text, text)
+--	zoom: the tile zoom level
+-- Returns:
+--	Same columns as get_tile(text, text, text, text).
+
+DROP function get_tile(text, text, text, text, int);
+CREATE FUNCTION get_tile(text, text, text, text, int)
+	RETURNS TABLE(cartodb_id text, type text, provider text, seasonality int, presence int, the_geom_webmercator geometry) 
+AS
+$$
+
+  DECLARE sql TEXT;
+  DECLARE data RECORD; -- a data table record
+  DECLARE band INT; -- the zoom band of the simplified geometries, null for full resolution
+  DECLARE geom_sql TEXT; -- the geometry column to select
+  DECLARE simplified_sql TEXT; -- the join to the simplified geometries, if any
+  BEGIN
+      -- Keep these bands in sync with create_mol_simplified_geoms()
+      band = CASE WHEN $5 <= 2 THEN 2 WHEN $5 <= 4 THEN 4 WHEN $5 <= 6 THEN 6 ELSE NULL END;
+      sql = 'SELECT * from data_registry WHERE provider = ''' || $1 || ''' and type = ''' || $2 || '''' ||
+      CASE WHEN $4 <> '' THEN 
+	'  or table_name = ''' || $4 || ''''
+	ELSE ''
+      END;
+      FOR data in EXECUTE sql LOOP
+         IF data.type = 'range' THEN
+                IF band IS NOT NULL AND EXISTS (SELECT 1 FROM pg_tables WHERE tablename = data.table_name || '_simplified') THEN
+                  geom_sql = ' s.the_geom_webmercator ';
+                  simplified_sql = ' JOIN ' || data.table_name || '_simplified s ON ' ||
+                    '   s.source_id = d.cartodb_id AND s.zoom_band = ' || band;
+                ELSE
+                  geom_sql = ' d.' || data.geometry_field;
+                  simplified_sql = '';
+                END IF;
+                sql := 'SELECT ' ||
+		  ' CONCAT('''|| data.table_name ||'-'', d.cartodb_id) as cartodb_id, ' ||
+                  ' TEXT('''||data.product_type||''') as type, TEXT('''||data.provider||''') as provider, ' ||
+                  ' CAST(' || data.seasonality || ' as int) as seasonality, ' || 
+                  ' CAST(' || data.presence || ' as int) as presence, ' || 
+                  geom_sql || 
+                  ' FROM ' || data.table_name || ' d ' || 
+                  simplified_sql ||
+                  ' WHERE ' ||  
+                  ' d.' || data.scientificname || ' = ''' || $3 || '''';               
+         ELSIF data.type = 'points' THEN
+                -- Points gain nothing from simplification
+                sql := 'SELECT ' ||
+		  ' CONCAT('''|| data.table_name ||'-'', cartodb_id) as cartodb_id, ' ||
+                  ' TEXT('''||data.product_type||''') as type, TEXT('''||data.provider||''') as provider, ' ||
+                  ' CAST(' || data.seasonality || ' as int) as seasonality, ' || 
+                  ' CAST(' || data.presence || ' as int) as presence, ' || 
+                  data.geometry_field || 
+                  ' FROM ' || data.table_name || 
+                  ' WHERE ' ||  
+                  data.scientificname || ' = ''' || $3 || '''';               
+         ELSIF data.type = 'taxogeochecklist' or data.type = 'taxogeooccchecklist' or data.type = 'geochecklist' THEN
+                IF band IS NOT NULL AND EXISTS (SELECT 1 FROM pg_tables WHERE tablename = data.geom_table || '_simplified') THEN
+                  geom_sql = ' s.the_geom_webmercator ';
+                  simplified_sql = ' JOIN ' || data.geom_table || '_simplified s ON ' ||
+                    '   s.source_id = g.' || data.geom_link_id || ' AND s.zoom_band = ' || band;
+                ELSE
+                  geom_sql = ' g.' || data.geometry_field;
+                  simplified_sql = '';
+                END IF;
+                sql := 'SELECT ' ||
+		  ' DISTINCT CONCAT('''|| data.table_name || '-'', d.cartodb_id) as cartodb_id, ' ||
+                  ' TEXT('''||data.product_type||''') as type, TEXT('''||data.provider||''') as provider, ' ||
+                  ' CAST(' || data.seasonality || ' as int) as seasonality, ' || 
+                  ' CAST(' || data.presence || ' as int) as presence, ' || 
+                  geom_sql || 
+                  ' FROM ' || data.table_name || ' d ' ||
+	          ' JOIN ' || data.geom_table || ' g ON ' ||
+                  '   d.' || data.geom_id || ' = g.' || data.geom_link_id  ||
+                  simplified_sql ||
+                  CASE WHEN data.type = 'geochecklist' THEN ''
+                  ELSE
+                  ' JOIN ' || data.taxo_table || ' t ON ' ||
+                  '   d.' || data.species_id || ' = t.' || data.species_link_id
+                  END ||
+		  ' WHERE ' || data.scientificname || ' = ''' || $3 || ''''; 
+           ELSE
+                -- We got nuttin'
+	  END IF;
+          RETURN QUERY EXECUTE sql;
+       END LOOP;
+    END
+
+$$  language plpgsql;
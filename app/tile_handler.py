@@ -8,46 +8,271 @@ import cache
 # Standard Python imports
 import hashlib
 import logging
-import os
+import struct
 import urllib
 import webapp2
+import zlib
 
 # Google App Engine imports
 from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from google.appengine.ext.webapp.util import run_wsgi_app
 
-if 'SERVER_SOFTWARE' in os.environ:
-    PROD = not os.environ['SERVER_SOFTWARE'].startswith('Development')
-else:
-    PROD = True
+# CartoDB Maps API host that renders tiles
+TILER_HOST = 'http://mol.cartodb.com'
 
-app_id = os.environ['CURRENT_VERSION_ID'].split('.')[0]
-if PROD:
-    host_prefix = 'http'
-    if os.environ['SERVER_PORT'] == 443:
-        host_prefix = 'https'
-    app_host = host_prefix + '://' + os.environ['SERVER_NAME'] 
-else:
-    app_host = 'http://localhost:8080'
+# Query parameters that change tile content. Anything else, like cache busters
+# or reordered parameters, is dropped from the cache key and the upstream URL.
+TILE_PARAMS = ['sql', 'style', 'interactivity', 'cache_key']
+
+# Web mercator half-width of the world in meters
+MERCATOR_MAX = 20037508.342789244
+
+# Vector tile coordinates are integers on a grid of this many cells per tile side
+VECTOR_TILE_EXTENT = 4096
+
+VECTOR_TILE_SQL = """SELECT cartodb_id, type, provider, seasonality, presence,
+  ST_SnapToGrid(ST_Affine(ST_SimplifyPreserveTopology(
+    ST_Intersection(the_geom_webmercator, ST_Expand(%(bbox)s, %(tolerance)f)),
+    %(tolerance)f), %(scale).17g, 0, 0, %(flip).17g, %(xoff)f, %(yoff)f), 1) AS the_geom
+FROM (%(sql)s) t
+WHERE the_geom_webmercator && %(bbox)s"""
+
+def vector_tile_sql(sql, z, x, y):
+    """Returns SQL that clips, simplifies and quantizes the geometries selected
+    by sql to the web mercator tile at z/x/y.
+
+    Coordinates are tile-local integers, as in Mapbox vector tiles: (0, 0) is
+    the top left corner of the tile and (VECTOR_TILE_EXTENT, VECTOR_TILE_EXTENT)
+    the bottom right one. Geometries reach slightly past the tile edges so
+    adjacent tiles overlap.
+    """
+    size = 2 * MERCATOR_MAX / (1 << z)
+    xmin = -MERCATOR_MAX + x * size
+    ymax = MERCATOR_MAX - y * size
+    bbox = 'ST_SetSRID(ST_MakeBox2D(ST_Point(%f, %f), ST_Point(%f, %f)), 3857)' % \
+        (xmin, ymax - size, xmin + size, ymax)
+    scale = VECTOR_TILE_EXTENT / size
+    return VECTOR_TILE_SQL % dict(
+        bbox=bbox, sql=sql, tolerance=size / 256, 
+        scale=scale, flip=-scale, xoff=-xmin * scale, yoff=ymax * scale)
+
+def tile_params(request):
+    """Returns the whitelisted (name, value) query parameters of a tile request
+    in canonical order."""
+    return [(name, request.get(name).encode('utf-8')) for name in TILE_PARAMS 
+            if request.get(name)]
+
+def canonical_tile_key(prefix, layer, z, x, y, params):
+    """Returns a canonical cache key for a tile.
+
+    Arguments:
+        prefix - The tile kind (tile, utfgrid, vtile).
+        layer, z, x, y - The tile coordinates parsed from the path.
+        params - The whitelisted query parameters from tile_params().
+
+    The key is made of the tile coordinates, a hash of the tile query, a hash
+    of the style and the data version (the cache_key parameter).
+    """
+    params = dict(params)
+    query = '%s|%s' % (params.get('sql', '').strip(), params.get('interactivity', ''))
+    return '%s-%s-%s-%s-%s-%s-%s-%s' % (
+        prefix, layer, z, x, y, 
+        hashlib.sha224(query).hexdigest()[:16],
+        hashlib.sha224(params.get('style', '').strip()).hexdigest()[:16],
+        params.get('cache_key', '0'))
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# Bytes per pixel of 8 bit PNG color types (gray, RGB, gray+alpha, RGBA)
+PNG_BYTES_PER_PIXEL = {0: 1, 2: 3, 4: 2, 6: 4}
+
+# Uniform tiles rendered from their sentinel, keyed by sentinel
+uniform_pngs = {}
+
+def png_chunks(png):
+    """Generates (type, data) tuples for the chunks of a PNG."""
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(png):
+        length = struct.unpack('>I', png[offset:offset + 4])[0]
+        chunk_type = png[offset + 4:offset + 8]
+        yield chunk_type, png[offset + 8:offset + 8 + length]
+        offset += length + 12
+
+def png_chunk(chunk_type, data):
+    """Returns an encoded PNG chunk."""
+    crc = zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+def paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    if pb <= pc:
+        return b
+    return c
+
+def filtered_uniform_rows(row, bpp):
+    """Returns the scanlines of a uniform image whose unfiltered rows are row
+    as encoded by each PNG filter type, for the first row and for every row
+    after it."""
+    row = [ord(b) for b in row]
+    encoded = []
+    for up in ([0] * len(row), row):
+        rows = []
+        for filter_type in range(5):
+            out = [chr(filter_type)]
+            for i, x in enumerate(row):
+                a = row[i - bpp] if i >= bpp else 0
+                b = up[i]
+                c = up[i - bpp] if i >= bpp else 0
+                predictor = [0, a, b, (a + b) // 2, paeth(a, b, c)][filter_type]
+                out.append(chr((x - predictor) % 256))
+            rows.append(''.join(out))
+        encoded.append(rows)
+    return encoded
+
+def uniform_palette_row(index, depth, width):
+    """Returns the packed scanline of a paletted image whose pixels all have
+    the palette index, with the unused bits of the last byte zeroed."""
+    byte = 0
+    for _ in range(8 // depth):
+        byte = (byte << depth) | index
+    row = chr(byte) * ((width * depth + 7) // 8)
+    tail = (width * depth) % 8
+    if tail:
+        row = row[:-1] + chr(byte & (0xff << (8 - tail)) & 0xff)
+    return row
+
+def uniform_png_sentinel(png):
+    """Returns a sentinel if every pixel of a non-interlaced PNG has the same
+    value, otherwise None. Fully transparent tiles share one sentinel.
+
+    Truecolor and grayscale images must be 8 bit. Paletted images of any depth
+    are uniform if every pixel has the same palette index, and get the sentinel
+    of the RGBA color that index maps to.
+
+    Scanlines are compared against the encodings a uniform row would have
+    under each filter type, so only the first pixel is ever decoded.
+    """
+    if not png.startswith(PNG_SIGNATURE):
+        return None
+    header, idat, palette, alphas = None, [], None, None
+    for chunk_type, data in png_chunks(png):
+        if chunk_type == 'IHDR':
+            header = struct.unpack('>IIBBBBB', data)
+        elif chunk_type == 'IDAT':
+            idat.append(data)
+        elif chunk_type == 'PLTE':
+            palette = data
+        elif chunk_type == 'tRNS':
+            alphas = data
+    if not header or not idat:
+        return None
+    width, height, depth, color_type, _, _, interlace = header
+    if interlace:
+        return None
+    if color_type == 3:
+        if depth not in (1, 2, 4, 8) or not palette:
+            return None
+        bpp = 1
+        stride = (width * depth + 7) // 8 + 1
+    else:
+        # tRNS makes one gray or RGB value transparent, it is not kept
+        bpp = PNG_BYTES_PER_PIXEL.get(color_type)
+        if depth != 8 or not bpp or alphas is not None:
+            return None
+        stride = width * bpp + 1
+    try:
+        raw = zlib.decompress(''.join(idat))
+    except zlib.error:
+        return None
+    if len(raw) != stride * height:
+        return None
+    # Every filter leaves the first pixel of the first row as is
+    if color_type == 3:
+        index = ord(raw[1]) >> (8 - depth)
+        row = uniform_palette_row(index, depth, width)
+    else:
+        row = raw[1:1 + bpp] * width
+    first, rest = filtered_uniform_rows(row, bpp)
+    if raw[0:stride] not in first:
+        return None
+    for offset in xrange(stride, len(raw), stride):
+        if raw[offset:offset + stride] not in rest:
+            return None
+    if color_type == 3:
+        if 3 * index + 3 > len(palette):
+            return None
+        alpha = alphas[index] if alphas and index < len(alphas) else '\xff'
+        pixel, color_type = palette[3 * index:3 * index + 3] + alpha, 6
+    else:
+        pixel = raw[1:1 + bpp]
+    if color_type == 6 and pixel[3] == '\x00':
+        pixel = '\x00' * 4
+    return 'uniform-%s-%s-%s-%s' % (width, height, color_type, pixel.encode('hex'))
+
+def uniform_png(sentinel):
+    """Returns the PNG for a sentinel made by uniform_png_sentinel()."""
+    if sentinel not in uniform_pngs:
+        _, width, height, color_type, pixel = sentinel.split('-')
+        width, height, color_type = int(width), int(height), int(color_type)
+        raw = ('\x00' + pixel.decode('hex') * width) * height
+        uniform_pngs[sentinel] = ''.join([
+            PNG_SIGNATURE,
+            png_chunk('IHDR', struct.pack(
+                '>IIBBBBB', width, height, 8, color_type, 0, 0, 0)),
+            png_chunk('IDAT', zlib.compress(raw, 9)),
+            png_chunk('IEND', '')])
+    return uniform_pngs[sentinel]
+
+def get_tile_png(tile_key):
+    """Returns the PNG stored for a tile key or None.
+
+    Tile keys map to either a uniform tile sentinel or to the content hash of
+    the PNG, which is stored once under png-<sha224> however many tiles share it.
+    """
+    ref = memcache.get(tile_key)
+    if not ref:
+        ref = cache.get(tile_key)
+        if not ref:
+            return None
+        memcache.add(tile_key, ref)
+    if ref.startswith('uniform-'):
+        return uniform_png(ref)
+    tile_png = memcache.get(ref)
+    if not tile_png:
+        tile_png = cache.get(ref, value_type='blob')
+        if tile_png:
+            memcache.add(ref, tile_png)
+    return tile_png
+
+def put_tile_png(tile_key, tile_png):
+    """Stores a PNG for a tile key, deduplicated by content."""
+    ref = uniform_png_sentinel(tile_png)
+    if not ref:
+        ref = 'png-%s' % hashlib.sha224(tile_png).hexdigest()
+        if not memcache.get(ref) and not cache.get(ref, value_type='blob'):
+            cache.add(ref, tile_png, value_type='blob')
+        memcache.add(ref, tile_png)
+    cache.add(tile_key, ref)
+    memcache.add(tile_key, ref)
 
 class TileHandler(webapp2.RequestHandler):
     """Request handler for cache requests."""
 
-    def get(self):
-        tile_url = self.request.url.replace(app_host, 'http://mol.cartodb.com')
-        tile_key = 'tile-%s' % hashlib.sha224(tile_url).hexdigest() # tc means Tile Cache
-        tile_png = memcache.get(tile_key) # Check memcache
+    def get(self, layer, z, x, y):
+        params = tile_params(self.request)
+        tile_url = '%s/tiles/%s/%s/%s/%s.png?%s' % (
+            TILER_HOST, layer, z, x, y, urllib.urlencode(params))
+        tile_key = canonical_tile_key('tile', layer, z, x, y, params)
+        tile_png = get_tile_png(tile_key) # Check memcache and datastore cache
         if not tile_png:
-            tile_png = cache.get(tile_key, value_type='blob') # Check datastore cache
-            if not tile_png:
-                result = urlfetch.fetch(tile_url, deadline=60) # Check CartoDB
-                if result.status_code == 200 or result.status_code == 304:
-                    tile_png = result.content
-                    cache.add(tile_key, tile_png, value_type='blob')
-                    memcache.add(tile_key, tile_png)
-            else:
-                    memcache.add(tile_key, tile_png)
+            result = urlfetch.fetch(tile_url, deadline=60) # Check CartoDB
+            if result.status_code == 200 or result.status_code == 304:
+                tile_png = result.content
+                put_tile_png(tile_key, tile_png)
         if not tile_png:
             self.error(404)
         else:
@@ -58,9 +283,11 @@ class TileHandler(webapp2.RequestHandler):
 class GridHandler(webapp2.RequestHandler):
     """Request handler for cache requests."""
 
-    def get(self):
-        grid_url = self.request.url.replace(app_host, 'http://mol.cartodb.com')
-        grid_key = 'utfgrid-%s' % hashlib.sha224(grid_url).hexdigest() # gc means Grid Cache
+    def get(self, layer, z, x, y):
+        params = tile_params(self.request)
+        grid_url = '%s/tiles/%s/%s/%s/%s.grid.json?%s' % (
+            TILER_HOST, layer, z, x, y, urllib.urlencode(params))
+        grid_key = canonical_tile_key('utfgrid', layer, z, x, y, params)
         grid_json = memcache.get(grid_key)
         if not grid_json:
             grid_json = cache.get(grid_key)            
@@ -78,10 +305,48 @@ class GridHandler(webapp2.RequestHandler):
             self.response.headers["Content-Type"] = "application/json"
             self.response.headers["Cache-Control"] = "max-age=2629743" # Cache 1 month
             self.response.out.write(grid_json)                    
+
+class VectorTileHandler(webapp2.RequestHandler):
+    """Request handler for GeoJSON vector tile requests. Coordinates are
+    tile-local integers (see vector_tile_sql)."""
+
+    def get(self, layer, z, x, y):
+        params = tile_params(self.request)
+        sql = dict(params).get('sql')
+        if not sql:
+            self.error(400)
+            return
+        z, x, y = int(z), int(x), int(y)
+        if x >= (1 << z) or y >= (1 << z):
+            self.error(404)
+            return
+        vtile_key = canonical_tile_key('vtile', layer, z, x, y, params)
+        vtile_json = memcache.get(vtile_key, namespace='vector-tiles')
+        if not vtile_json:
+            vtile_json = cache.get(vtile_key)
+            if not vtile_json:
+                payload = urllib.urlencode(
+                    dict(format='geojson', q=vector_tile_sql(sql, z, x, y)))
+                result = urlfetch.fetch(
+                    '%s/api/v2/sql' % TILER_HOST, payload=payload, 
+                    method='POST', deadline=60)
+                if result.status_code == 200:
+                    vtile_json = result.content
+                    cache.add(vtile_key, vtile_json)
+                    memcache.add(vtile_key, vtile_json, namespace='vector-tiles')
+            else:
+                memcache.add(vtile_key, vtile_json, namespace='vector-tiles')
+        if not vtile_json:
+            self.error(404)
+        else:
+            self.response.headers["Content-Type"] = "application/json"
+            self.response.headers["Cache-Control"] = "max-age=2629743" # Cache 1 month
+            self.response.out.write(vtile_json)
                     
 application = webapp2.WSGIApplication(
-    [('/tiles/[a-zA-Z0-9_-]+/[\d]+/[\d]+/[\d]+.png?.*', TileHandler),
-     ('/tiles/[a-zA-Z0-9_-]+/[\d]+/[\d]+/[\d]+.grid.json?.*', GridHandler),], 
+    [('/tiles/([a-zA-Z0-9_-]+)/([\d]+)/([\d]+)/([\d]+)\.png', TileHandler),
+     ('/tiles/([a-zA-Z0-9_-]+)/([\d]+)/([\d]+)/([\d]+)\.grid\.json', GridHandler),
+     ('/tiles/([a-zA-Z0-9_-]+)/([\d]+)/([\d]+)/([\d]+)\.geojson', VectorTileHandler),], 
     debug=True)
          
 def main():
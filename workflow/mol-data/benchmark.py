@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Gaurav Vaidya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Per-stage timing for loader.py's --benchmark mode.
+
+loader.py wraps each stage of an upload (conversion, parsing, mapping,
+hashing, encoding, upload) in Benchmark.stage(). Stages may nest: time spent
+in an inner stage is not counted against the outer one, so (for instance)
+waiting for ogr2ogr doesn't show up as parsing time.
+
+Run this file directly to start a stand-in for the CartoDB SQL API, which
+loader.py can upload to with --sql-endpoint:
+
+    python benchmark.py --port 8080 --latency 50
+    python loader.py -s datasets/jetz --sql-endpoint http://localhost:8080/ --benchmark jetz.json
+"""
+
+import array
+import BaseHTTPServer
+import contextlib
+import logging
+import simplejson
+import SocketServer
+import threading
+import time
+from optparse import OptionParser
+
+class Benchmark(object):
+    """Collects the time spent in each stage of an upload."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.total_features = 0
+        self.durations = {}
+        self.features = {}
+        self.bytes = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, features=0, bytes=0):
+        """Times the enclosed block as part of the named stage."""
+        if not self.enabled:
+            yield
+            return
+
+        stack = self.local.__dict__.setdefault('stack', [])
+        # [time spent in nested stages]
+        nested = [0.0]
+        stack.append(nested)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            stack.pop()
+            if stack:
+                stack[-1][0] += elapsed
+            self.record(name, elapsed - nested[0], features, bytes)
+
+    def timed(self, iterable, name):
+        """Generates the items of iterable, timing each step as the named stage."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    return
+            yield item
+
+    def record(self, name, seconds, features=0, bytes=0):
+        """Records time spent in a stage, and how many features and bytes it handled."""
+        if not self.enabled:
+            return
+
+        with self.lock:
+            if name not in self.durations:
+                self.durations[name] = array.array('d')
+                self.features[name] = 0
+                self.bytes[name] = 0
+            self.durations[name].append(seconds)
+            self.features[name] += features
+            self.bytes[name] += bytes
+
+    def add_features(self, count=1):
+        """Counts features that made it all the way through the loader."""
+        if self.enabled:
+            with self.lock:
+                self.total_features += count
+
+    def report(self):
+        """Returns the timings collected so far as a dict, ready to be written as JSON."""
+        with self.lock:
+            elapsed = max(time.time() - self.started, 0.001)
+            stages = {}
+            for (name, durations) in self.durations.iteritems():
+                total = sum(durations)
+                ordered = sorted(durations)
+
+                def percentile(p):
+                    return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))] * 1000
+
+                stages[name] = {
+                    'count': len(durations),
+                    'seconds': total,
+                    'features': self.features[name],
+                    'bytes': self.bytes[name],
+                    'features_per_second': self.features[name] / total if total else None,
+                    'bytes_per_second': self.bytes[name] / total if total else None,
+                    'ms': {
+                        'p50': percentile(50),
+                        'p90': percentile(90),
+                        'p99': percentile(99),
+                        'max': ordered[-1] * 1000
+                    }
+                }
+
+            return {
+                'elapsed_seconds': elapsed,
+                'features': self.total_features,
+                'features_per_second': self.total_features / elapsed,
+                'stages': stages
+            }
+
+    def write(self, filename):
+        """Writes the report to a JSON file, and summarizes it in the log."""
+        report = self.report()
+        with open(filename, 'w') as f:
+            simplejson.dump(report, f, indent=4, sort_keys=True)
+
+        logging.info("Benchmark: %d features in %.1fs (%.1f features/s); report written to %s.",
+            report['features'], report['elapsed_seconds'], report['features_per_second'], filename)
+        for (name, stage) in sorted(report['stages'].iteritems(), key=lambda x: -x[1]['seconds']):
+            logging.info("Benchmark:   %-12s %8.2fs over %8d calls (p50 %.3fms, p99 %.3fms)",
+                name, stage['seconds'], stage['count'], stage['ms']['p50'], stage['ms']['p99'])
+
+class StandInSQLHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Accepts SQL API requests and answers them with an empty result, after
+    waiting for the server's latency."""
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.rfile.read(length)
+        self.respond()
+
+    def do_GET(self):
+        self.respond()
+
+    def respond(self):
+        time.sleep(self.server.latency)
+        body = simplejson.dumps({'rows': [], 'total_rows': 0, 'time': self.server.latency})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--port', type="int", dest="port", default=8080,
+        help="The port to serve the stand-in SQL endpoint on.")
+    parser.add_option('--latency', type="int", dest="latency", default=0, metavar="MS",
+        help="How long each request should take, in milliseconds.")
+    options = parser.parse_args()[0]
+
+    logging.basicConfig(level=logging.INFO)
+
+    class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        # Serve each upload worker's requests in parallel.
+        daemon_threads = True
+
+    server = ThreadedHTTPServer(('localhost', options.port), StandInSQLHandler)
+    server.latency = options.latency / 1000.0
+    logging.info("Stand-in SQL endpoint listening on http://localhost:%d/", options.port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
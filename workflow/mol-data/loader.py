@@ -20,26 +20,36 @@
 
 """
 
+import binascii
 import codecs
+import collections
 import csv
 import decimal
 import glob
 import hashlib
+import itertools
 import logging
 import os
 import pprint
+import Queue
 import random
 import shapely.geometry
 import simplejson
+import struct
 import subprocess
 import sys
+import threading
 import time
+import urllib
+import urllib2
 
 from cartodb import CartoDB,CartoDBException
 from optparse import OptionParser
 from zipfile import ZipFile
 
+from benchmark import Benchmark
 from providerconfig import ProviderConfig
+from uploadjournal import UploadJournal
 from unicodewriter import UnicodeDictReader
 
 # The default directory where datasets may be found. Set this back to
@@ -47,24 +57,115 @@ from unicodewriter import UnicodeDictReader
 # current directory.
 DEFAULT_DATASETS_DIR = 'datasets'
 
+# How many feature hashes to download from CartoDB in each request.
+FEATURE_HASH_PAGE_SIZE = 10000
+
+# The files which make up a shapefile, whose sizes and modification times
+# decide whether a cached GeoJSON conversion is still good.
+SHAPEFILE_COMPONENTS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+# How many times to try an SQL statement before giving up on it.
+SQL_TRIES = 10
+
+# Adaptive batch sizing (--adaptive): the byte budget to start from if 
+# --batch-bytes isn't given, the smallest budget we'll shrink to, and how 
+# many times to try a batch before checking whether CartoDB reported an 
+# SQL error for it (batches that fail otherwise get the rest of SQL_TRIES).
+ADAPTIVE_INITIAL_BATCH_BYTES = 256 * 1024
+ADAPTIVE_MIN_BATCH_BYTES = 16 * 1024
+ADAPTIVE_TRIES = 2
+
+# How many rows of a point CSV file to read and convert at a time.
+CSV_CHUNK_SIZE = 50000
+
+# A little-endian 2D WKB point: byte order, geometry type (1 = Point), x, y.
+# This is exactly what shapely produces for a point on x86.
+WKB_POINT = struct.Struct('<BIdd')
+
 # Some global functions.
 
-def generate_feature_hash(feature):
+def generate_feature_hash(feature, legacy=False):
     """ Generates a hash for a 'geo' feature. The challenge here is to
     ensure that this hash will look the same for ever 'geo' object,
     on every computer, ever. Good luck.
+
+    The hash is a SHA-1 of the feature's properties, serialized as JSON with
+    sorted keys, followed by the WKB of its geometry, rendered as lowercase
+    hexadecimal digits.
+
+    Collections uploaded by older versions of this script were hashed from
+    the pprint.pformat() of the whole feature, rendered as uppercase 
+    hexadecimal digits; set legacy to True to generate those hashes.
     """
 
-    # We need pformat only because it sorts dictionary keys alphabetically,
-    # and will not trip up if we ever have dictionaries-inside-dictionaries,
-    # etc.
-    str = pprint.pformat(feature)
-    
-    # We use SHA-1 hashes, rendered as uppercase hexadecimal digits.
-    hash = hashlib.sha1(str).hexdigest().upper()
+    if legacy:
+        # We need pformat only because it sorts dictionary keys alphabetically,
+        # and will not trip up if we ever have dictionaries-inside-dictionaries,
+        # etc.
+        # The memoized WKB wasn't part of the feature when these hashes were made.
+        str = pprint.pformat(dict((k, v) for (k, v) in feature.iteritems() if k != 'wkb'))
+        
+        # We use SHA-1 hashes, rendered as uppercase hexadecimal digits.
+        return hashlib.sha1(str).hexdigest().upper()
+
+    str = simplejson.dumps(feature['properties'], sort_keys=True, separators=(',', ':'))
+    hash = hashlib.sha1(str)
+    hash.update('\0')
+    hash.update(getFeatureWKB(feature) or '')
 
     # print "Hash [%s] generated from «%s»." % (hash, str)
-    return hash
+    return hash.hexdigest()
+
+def getFeatureWKB(feature):
+    """ Returns the WKB of a feature's geometry, or None if it can't be parsed.
+    The WKB is remembered in feature['wkb'], so it is only computed once for
+    hashing and encoding.
+    """
+    if 'wkb' not in feature:
+        try:
+            feature['wkb'] = shapely.geometry.asShape(feature['geometry']).wkb
+            # We can use SRID=4326 because we loaded it in that SRID from
+            # ogr2ogr.
+        except ValueError as e:
+            logging.error("Error parsing '%s' as geometry: %s" % (feature['geometry'], e))
+            feature['wkb'] = None
+    return feature['wkb']
+
+class FeatureHashSet(object):
+    """ A compact set of feature hashes, stored as raw SHA-1 digests.
+
+    Hashes are added and looked up as hexadecimal strings. 'legacy' is set 
+    if any of the hashes added were generated by the legacy (uppercase) hash.
+    Anything that isn't a hexadecimal string (which no feature can hash to) 
+    is ignored.
+    """
+
+    def __init__(self):
+        self.digests = set()
+        self.legacy = False
+
+    def add(self, feature_hash):
+        try:
+            digest = binascii.unhexlify(feature_hash)
+        except TypeError:
+            return
+        if feature_hash != feature_hash.lower():
+            self.legacy = True
+        self.digests.add(digest)
+
+    def __contains__(self, feature_hash):
+        try:
+            return binascii.unhexlify(feature_hash) in self.digests
+        except TypeError:
+            return False
+
+    def __len__(self):
+        return len(self.digests)
+
+    def __iter__(self):
+        for digest in self.digests:
+            feature_hash = binascii.hexlify(digest)
+            yield feature_hash.upper() if self.legacy else feature_hash
 
 # TODO: Best just get rid of this and use a global variable?
 class ogr2ogrPathDetection(object):
@@ -98,6 +199,12 @@ cartodb = None
 # The CartoDB setting used to login to the server.
 cartodb_settings = None
 
+# Per-stage timings, collected if --benchmark is in use.
+benchmark = Benchmark(enabled=False)
+
+# The AdaptiveBatchSize used to size batches if --adaptive is in use.
+batch_sizer = None
+
 def uploadToCartoDB(provider_dir):
     """Uploads the given directory to CartoDB. At the moment, all collection data is
     deleted on the server during upload (this will be fixed for issue #27).
@@ -110,6 +217,39 @@ def uploadToCartoDB(provider_dir):
     # How many SQL statements should we run together?
     sql_statements_to_send_at_once = _getoptions().simultaneous_sql_statements;
 
+    # Or should we adapt the size of each batch to how the server copes?
+    global batch_sizer
+    if _getoptions().adaptive and batch_sizer is None:
+        batch_sizer = AdaptiveBatchSize(
+            _getoptions().batch_bytes or ADAPTIVE_INITIAL_BATCH_BYTES,
+            _getoptions().max_batch_bytes,
+            _getoptions().target_latency)
+
+    def newBatch():
+        if batch_sizer is not None:
+            return SQLBatch(_getoptions().table_name, sql_statements_to_send_at_once, batch_sizer.max_bytes())
+        return SQLBatch(_getoptions().table_name, sql_statements_to_send_at_once, _getoptions().batch_bytes)
+
+    # Send batches from several workers at once?
+    upload_pool = None
+    if _getoptions().workers > 1:
+        upload_pool = UploadPool(_getoptions().workers)
+
+    def transmit(batch, journal):
+        logging.info("\tBatch-transmitting %d SQL statements (%d bytes) to CartoDB." % (len(batch), batch.size))
+
+        # Journal the batch before sending it, and mark it committed once it has been.
+        on_commit = None
+        if journal is not None:
+            batch_id = journal.begin_batch(batch.feature_hashes)
+            on_commit = lambda: journal.commit_batch(batch_id)
+
+        if upload_pool is None:
+            if sendBatchToCartoDB(batch) and on_commit is not None:
+                on_commit()
+        else:
+            upload_pool.submit(batch, on_commit)
+
     # We wrap this processing in a try-finally so that, no matter what happens,
     # we change back to the original directory before we leave this subroutine.
     try:
@@ -121,33 +261,70 @@ def uploadToCartoDB(provider_dir):
         for collection in config.collections():
             features = getCollectionIterator(_getoptions().table_name, collection)
 
+            # Open the upload journal for this collection, if we're keeping one.
+            journal = None
+            if _getoptions().journal_dir:
+                if _getoptions().dummy_run:
+                    logging.warning("Not keeping an upload journal during a dummy run.")
+                else:
+                    journal = UploadJournal(_getoptions().journal_dir, 
+                        _getoptions().table_name, 
+                        collection.get_provider(), 
+                        collection.get_name())
+
             # Delete previous entries from this provider/collection combination.
             if _getoptions().reset_collection:
                 deletePreviousEntries(_getoptions().table_name, collection.get_provider(), collection.get_collection())
+                if journal is not None:
+                    journal.clear()
 
             # Check feature hashes, so we don't reupload existing entries.
-            logging.info("Downloading feature hashes for table '%s', provider '%s', collection '%s' to prevent duplicate uploads.",
-                _getoptions().table_name, 
-                collection.get_provider(), 
-                collection.get_name()
-            )
-            uploaded_feature_hashes = []
-            if _getoptions().rows_to_skip == 0:
+            uploaded_feature_hashes = FeatureHashSet()
+            in_flight_hashes = set()
+            if journal is not None and journal.has_server_hashes():
+                # Resuming an upload: the journal knows what the server has.
+                for feature_hash in journal.committed_hashes():
+                    uploaded_feature_hashes.add(feature_hash)
+                in_flight_hashes = journal.in_flight_hashes()
+                logging.info("%d feature hashes read from the upload journal; %d features from unconfirmed batches will be resent.", 
+                    len(uploaded_feature_hashes), len(in_flight_hashes))
+            elif _getoptions().rows_to_skip == 0:
+                logging.info("Downloading feature hashes for table '%s', provider '%s', collection '%s' to prevent duplicate uploads.",
+                    _getoptions().table_name, 
+                    collection.get_provider(), 
+                    collection.get_name()
+                )
                 uploaded_feature_hashes = getUploadedFeatureHashes(
                     _getoptions().table_name, 
                     collection.get_provider(), 
                     collection.get_name()
                 )
                 logging.info("%d feature hashes downloaded.", len(uploaded_feature_hashes))
+                if journal is not None:
+                    journal.record_server_hashes(uploaded_feature_hashes)
             else:
                 logging.info("%d feature hashes downloaded: --skip-rows %d in operation.", len(uploaded_feature_hashes), _getoptions().rows_to_skip)
+                # Still find out which hash the collection was uploaded with, 
+                # so the rows we add can be matched by later runs.
+                uploaded_feature_hashes.legacy = hasLegacyFeatureHashes(
+                    _getoptions().table_name, 
+                    collection.get_provider(), 
+                    collection.get_name()
+                )
+
+            # Keep using the legacy hash on collections that were uploaded with it,
+            # or every feature would look new. Use --reset to rehash a collection.
+            legacy_hashes = uploaded_feature_hashes.legacy
+            if legacy_hashes:
+                logging.warning("Collection '%s' was uploaded with legacy feature hashes; using the (slower) legacy hash.", collection.get_name())
             
-            # We currently combine three SQL statements into a single statement for transmission to CartoDB.
-            sql_statements = set()
+            # We combine several SQL statements (or rows) into a single statement for transmission to CartoDB.
+            batch = newBatch()
 
             rows_to_skip = _getoptions().rows_to_skip
             row_count = 0
-            for feature in features:
+            mapping_plans = {}
+            for feature in benchmark.timed(features, 'parsing'):
                 row_count += 1
 
                 if(rows_to_skip > 0 and row_count <= rows_to_skip):
@@ -155,48 +332,53 @@ def uploadToCartoDB(provider_dir):
                     continue
 
                 properties = feature['properties']
-                new_properties = collection.default_fields()
 
-                # Map the properties over.
-                for key in properties.keys():
-                    (new_key, new_value) = collection.map_field(row_count, key, properties[key])
-                    if new_value is not None:
-                        # print "Mapping %s as %s." % (new_key, new_value)
-                        new_properties[new_key] = unicode(new_value)
+                # Map the properties over, compiling a mapping plan the first time 
+                # we see a particular set of source fields.
+                with benchmark.stage('mapping'):
+                    source_fields = tuple(properties)
+                    plan = mapping_plans.get(source_fields)
+                    if plan is None:
+                        plan = mapping_plans[source_fields] = collection.mapping_plan(source_fields)
+                    new_properties = collection.apply_mapping_plan(plan, row_count, properties)
 
-                collection.verify_fields(properties['filename'], new_properties)
-                feature['properties'] = new_properties
+                    collection.verify_fields(properties['filename'], new_properties)
+                    feature['properties'] = new_properties
 
-                feature_hash = generate_feature_hash(feature) 
+                with benchmark.stage('hashing'):
+                    feature_hash = generate_feature_hash(feature, legacy_hashes)
                 if feature_hash in uploaded_feature_hashes:
                     if not _getoptions().replace:
                         logging.info("\tFeature #%d has already been uploaded (hash matches)" % row_count)
                         continue
                     else:
-                        tag = random.randint(100000, 99999999).__str__()
-                        sql_statements.add("DELETE FROM %s WHERE provider=%s AND collection=%s AND featurehash=%s" %
-                            (_getoptions().table_name, 
-                            '$tag_' + tag + '$' + collection.get_provider() + '$tag_' + tag + '$',
-                            '$tag_' + tag + '$' + collection.get_name() + '$tag_' + tag + '$',
-                            '$tag_' + tag + '$' + feature_hash + '$tag_' + tag + '$'
-                            )
-                        )
+                        batch.add_statement(encodeFeatureDeleteAsSQL(_getoptions().table_name, collection, feature_hash))
+                elif feature_hash in in_flight_hashes:
+                    # The server may have committed this feature just before we lost 
+                    # track of its batch, so delete any copy before resending it.
+                    logging.info("\tFeature #%d was in an unconfirmed batch; resending." % row_count)
+                    batch.add_statement(encodeFeatureDeleteAsSQL(_getoptions().table_name, collection, feature_hash))
                 feature['properties']['FeatureHash'] = feature_hash
 
                 # Prepare SQL for upload to CartoDB.
                 logging.info("\tPreparing SQL for feature #%d" % row_count);
-                sql_statements.add(encodeGeoJSONEntryAsSQL(feature, _getoptions().table_name))
-
-                if(len(sql_statements) >= sql_statements_to_send_at_once):
-                    logging.info("\tBatch-transmitting %d SQL statements to CartoDB." % len(sql_statements))
-                    sendSQLStatementToCartoDB("; ".join(sql_statements))
-                    sql_statements.clear()
-
-            # Anything still left in sql_statements? Process and upload them now.
-            if(len(sql_statements) > 0):
-                logging.info("\tBatch-transmitting %d SQL statements to CartoDB." % len(sql_statements))
-                sendSQLStatementToCartoDB("; ".join(sql_statements))
-                sql_statements.clear()
+                with benchmark.stage('encoding', features=1):
+                    batch.add_feature(feature)
+                benchmark.add_features()
+
+                if batch.is_full():
+                    transmit(batch, journal)
+                    batch = newBatch()
+
+            # Anything still left in the batch? Process and upload it now.
+            if len(batch) > 0:
+                transmit(batch, journal)
+
+            # Finish uploading this collection before starting on the next one.
+            if upload_pool is not None:
+                upload_pool.join()
+            if journal is not None:
+                journal.close()
             
             logging.info("Uploaded %d features from collection '%s' (provider '%s').", row_count, collection.get_name(), collection.get_provider());
 
@@ -207,6 +389,8 @@ def uploadToCartoDB(provider_dir):
         logging.info("Processing of directory '%s' completed." % provider_dir)
 
     finally:
+        if upload_pool is not None:
+            upload_pool.close()
         os.chdir(original_dir)
 
     logging.info("Leaving directory '%s'." % provider_dir)
@@ -224,21 +408,33 @@ def getCollectionIterator(table_name, collection):
         (name.lower().rfind('.txt', len(name) - 4, len(name)) != -1)):
         return getFeaturesFromLatLongCsvFile(collection, name)
 
+def hasLegacyFeatureHashes(table_name, provider, collection):
+    """ Returns True if a few sample rows show that a collection was uploaded with 
+    the legacy (uppercase) feature hash, without downloading every hash.
+    """
+    global cartodb
+
+    if cartodb is None:
+        cartodb = createCartoDBClient()
+
+    quoted_provider = "$a_complicated_tag_here$%s$a_complicated_tag_here$" % provider
+    quoted_collection = "$another_complicated_tag_here$%s$another_complicated_tag_here$" % collection
+
+    results = cartodb.sql(
+        "SELECT FeatureHash FROM %s WHERE provider=%s AND collection=%s AND FeatureHash IS NOT NULL LIMIT 10" %
+            (table_name, quoted_provider, quoted_collection)
+    )
+    hashes = FeatureHashSet()
+    for row in results['rows']:
+        hashes.add(row['featurehash'])
+    return hashes.legacy
+
 def getUploadedFeatureHashes(table_name, provider, collection):
     global cartodb
     global cartodb_settings
 
     if cartodb is None:
-        cartodb = CartoDB(
-            cartodb_settings['CONSUMER_KEY'],
-            cartodb_settings['CONSUMER_SECRET'],
-            cartodb_settings['user'],
-            cartodb_settings['password'],
-            cartodb_settings['user'],
-            host=cartodb_settings['domain'],
-            protocol=cartodb_settings['protocol'],
-            access_token_url=cartodb_settings['access_token_url']
-        )
+        cartodb = createCartoDBClient()
 
     # This seems like a tempting place to cache results, but actually
     # isn't, since this function should only run once for any collection.
@@ -247,16 +443,27 @@ def getUploadedFeatureHashes(table_name, provider, collection):
     quoted_provider = "$a_complicated_tag_here$%s$a_complicated_tag_here$" % provider
     quoted_collection = "$another_complicated_tag_here$%s$another_complicated_tag_here$" % collection
 
-    results = cartodb.sql(
-        "SELECT FeatureHash FROM %s WHERE provider=%s AND collection=%s" % 
-            (table_name, quoted_provider, quoted_collection)
-    )
-    rows = results['rows']
+    # Page through the hashes in cartodb_id order, so no single response
+    # has to hold the whole collection.
+    hashes = FeatureHashSet()
+    last_id = 0
+    while True:
+        results = cartodb.sql(
+            "SELECT cartodb_id, FeatureHash FROM %s WHERE provider=%s AND collection=%s AND cartodb_id > %d ORDER BY cartodb_id LIMIT %d" % 
+                (table_name, quoted_provider, quoted_collection, last_id, FEATURE_HASH_PAGE_SIZE)
+        )
+        rows = results['rows']
+
+        # TODO: We should probably check for hash-collision here, just in case.
+        for row in rows:
+            if row['featurehash']:
+                hashes.add(row['featurehash'])
 
-    # TODO: We should probably check for hash-collision here, just in case.
+        if len(rows) < FEATURE_HASH_PAGE_SIZE:
+            break
+        last_id = rows[-1]['cartodb_id']
+        logging.info("\t%d feature hashes downloaded so far.", len(hashes))
 
-    hashes = dict((row['featurehash'], 1) for row in rows)
-    # print "Hashes: " + ", ".join(hashes.keys())
     return hashes
 
 def getFeaturesFromShapefileDir(collection, name):
@@ -270,107 +477,303 @@ def getFeaturesFromShapefileDir(collection, name):
         # Filenames are stored case-sensitively when uploaded to CartoDB.
         shapefiles.sort()
 
-        for shapefile in shapefiles:
-            # Determine the "name" (filename without extension) of this file.
-            filename = shapefile[0:shapefile.index('.shp')]
-
-            logging.info("Processing shapefile: %s." % filename)
-
-            # Step 2.1. Convert this shapefile into a GeoJSON file, projected to
-            # EPSG 4326 (WGS 84).
-            json_filename = '%s.json' % filename
-            
-            # Delete existing geojson file since we're appending.
-            if os.path.exists(json_filename):
-                os.remove(json_filename)
+        # Determine the "name" (filename without extension) of each file.
+        filenames = [shapefile[0:shapefile.index('.shp')] for shapefile in shapefiles]
 
-            command = [ogr2ogr_path(), 
-                '-f', 'GeoJSON', 
-                '-t_srs', 'EPSG:4326',
-                json_filename,
-                '%s.shp' % filename
-            ]
-
-            try:
-                subprocess.call(command)
-            except Exception as e:
-                logging.error('Unable to convert %s to GeoJSON: %s (command: %s)' % (name, e, command))
-                if os.path.exists(json_filename):
-                    os.remove(json_filename)
+        # Step 2.1. Convert these shapefiles into GeoJSON files, projected to
+        # EPSG 4326 (WGS 84). Later files are converted while we upload earlier ones.
+        for (filename, json_filename) in convertShapefiles(filenames, _getoptions().convert_workers):
+            if json_filename is None:
                 continue
 
-            # Step 2.2. Load that GeoJSON file and do the mapping.
-            #logging.info('Mapping fields from DBF to specification: %s' % json_filename)
-            geojson = None
-            try:
-                geojson = simplejson.loads(
-                    codecs.open(json_filename, encoding='latin-1').read(), 
-                    parse_float=lambda x: decimal.Decimal("%.6f" % round(float(x), 6)),
-                    encoding='utf-8')
+            logging.info("Processing shapefile: %s." % filename)
 
-            except Exception as e:
+            # Step 2.2. Stream features out of that GeoJSON file and do the mapping.
+            row_count = 0
+            try:
+                for feature in iterGeoJSONFeatures(json_filename):
+                    row_count += 1
+                    properties = feature['properties']
+                    properties['provider'] = collection.get_provider()
+                    properties['collection'] = collection.get_name()
+                    properties['filename'] = filename + ".shp"
+                    properties['row'] = row_count
+                    yield feature
+
+            except (IOError, ValueError) as e:
                 logging.error('Unable to open or process %s: %s' % (json_filename, e.__str__()))
                 exit(1)
 
-            row_count = 0
-            for feature in geojson['features']:
-                row_count += 1
-                properties = feature['properties']
-                properties['provider'] = collection.get_provider()
-                properties['collection'] = collection.get_name()
-                properties['filename'] = filename + ".shp"
-                properties['row'] = row_count
-                yield feature
-
     finally:
         # Return to the provider dir.
         os.chdir('..')
 
+def shapefileSignature(filename, command):
+    """Returns a signature for a shapefile (given without its '.shp') and the
+    ogr2ogr command used to convert it, made from the sizes and modification
+    times of the files making up the shapefile. If the signature hasn't 
+    changed, neither has the GeoJSON it converts into.
+    """
+    signature = hashlib.sha1("\0".join(command))
+    for extension in SHAPEFILE_COMPONENTS:
+        path = filename + extension
+        if os.path.exists(path):
+            stat = os.stat(path)
+            signature.update("\0%s:%d:%r" % (extension, stat.st_size, stat.st_mtime))
+    return signature.hexdigest()
+
+def startShapefileConversion(filename):
+    """Starts converting a shapefile (given without its '.shp') into GeoJSON.
+    
+    ogr2ogr writes into a temporary file, which finishShapefileConversion()
+    renames once it is complete; a '.stamp' file next to the GeoJSON file 
+    records the signature of the shapefile it was converted from, so a 
+    conversion is only repeated if the shapefile has changed.
+
+    Returns: a (filename, json_filename, signature, process) tuple for 
+        finishShapefileConversion(). process is None if the cached
+        conversion is still good, or False if ogr2ogr couldn't be started.
+    """
+    json_filename = '%s.json' % filename
+    stamp_filename = json_filename + '.stamp'
+    temp_filename = json_filename + '.tmp'
+
+    command = [ogr2ogr_path(), 
+        '-f', 'GeoJSON', 
+        '-t_srs', 'EPSG:4326',
+        temp_filename,
+        '%s.shp' % filename
+    ]
+    signature = shapefileSignature(filename, command)
+
+    if os.path.exists(json_filename) and os.path.exists(stamp_filename):
+        with open(stamp_filename, 'r') as stamp:
+            if stamp.read().strip() == signature:
+                logging.info("Shapefile %s is unchanged since it was last converted; using %s." % (filename, json_filename))
+                return (filename, json_filename, signature, None)
+
+    # ogr2ogr won't overwrite an existing GeoJSON file.
+    for old_filename in (temp_filename, stamp_filename):
+        if os.path.exists(old_filename):
+            os.remove(old_filename)
+
+    logging.info("Converting shapefile %s to GeoJSON." % filename)
+    try:
+        process = subprocess.Popen(command)
+    except Exception as e:
+        logging.error('Unable to convert %s to GeoJSON: %s (command: %s)' % (filename, e, command))
+        process = False
+
+    return (filename, json_filename, signature, process)
+
+def finishShapefileConversion(filename, json_filename, signature, process):
+    """Waits for a conversion started by startShapefileConversion() to finish.
+
+    Returns: (filename, json_filename), where json_filename is None if the 
+        shapefile could not be converted.
+    """
+    if process is None:
+        return (filename, json_filename)
+
+    temp_filename = json_filename + '.tmp'
+    if process is False or process.wait() != 0:
+        if process:
+            logging.error('Unable to convert %s to GeoJSON: ogr2ogr exited with status %d' % (filename, process.returncode))
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        return (filename, None)
+
+    os.rename(temp_filename, json_filename)
+    with open(json_filename + '.stamp', 'w') as stamp:
+        stamp.write(signature + "\n")
+
+    return (filename, json_filename)
+
+def convertShapefiles(filenames, workers=1):
+    """Converts shapefiles (given without their '.shp') into GeoJSON, running
+    up to 'workers' ogr2ogr processes at a time.
+
+    Generates a (filename, json_filename) tuple for each shapefile, in order,
+    as soon as it has been converted, so that the caller can process one file
+    while the following ones are still converting. json_filename is None if
+    the shapefile could not be converted.
+    """
+    filenames = iter(filenames)
+    pending = collections.deque()
+    while True:
+        for filename in itertools.islice(filenames, max(workers, 1) - len(pending)):
+            with benchmark.stage('conversion'):
+                pending.append(startShapefileConversion(filename))
+
+        if len(pending) == 0:
+            return
+
+        with benchmark.stage('conversion'):
+            converted = finishShapefileConversion(*pending.popleft())
+        yield converted
+
+def iterGeoJSONFeatures(json_filename, chunk_size=1024 * 1024):
+    """Generates the features of a GeoJSON FeatureCollection one at a time,
+    without loading the whole file into memory.
+
+    The file is read in chunks and each element of the 'features' array is
+    decoded as soon as it is complete, so memory use is bounded by the largest
+    single feature rather than by the size of the file. Features are decoded
+    exactly as a full simplejson.loads() would have decoded them (latin-1 input,
+    coordinates rounded to six decimal places as Decimals), so feature hashes
+    do not change.
+
+    Arguments:
+        json_filename: The GeoJSON file written by ogr2ogr.
+        chunk_size: The number of characters to read at a time.
+
+    Raises IOError if the file can't be read, and ValueError if it is not a
+    GeoJSON FeatureCollection.
+    """
+    decoder = simplejson.JSONDecoder(
+        parse_float=lambda x: decimal.Decimal("%.6f" % round(float(x), 6)))
+
+    jsonfile = codecs.open(json_filename, encoding='latin-1')
+    try:
+        buf = u''
+        eof = False
+
+        # Find the start of the features array.
+        while True:
+            start = buf.find('"features"')
+            if start != -1:
+                start = buf.find('[', start)
+            if start != -1:
+                break
+            if eof:
+                raise ValueError("No 'features' array found in %s" % json_filename)
+            data = jsonfile.read(chunk_size)
+            eof = (data == u'')
+            buf += data
+        pos = start + 1
+
+        # Decode one feature at a time. If a feature is incomplete, read
+        # more of the file, doubling the amount read each time so that very
+        # large features don't take quadratic time to decode.
+        read_size = chunk_size
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            try:
+                if pos >= len(buf):
+                    raise ValueError("Need more data")
+                (feature, end) = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise ValueError("Truncated features array in %s" % json_filename)
+                data = jsonfile.read(read_size)
+                eof = (data == u'')
+                buf = buf[pos:] + data
+                pos = 0
+                read_size *= 2
+                continue
+
+            # Only drop decoded features from the buffer when more is read,
+            # so that a chunk of small features isn't copied once per feature.
+            read_size = chunk_size
+            pos = end
+            yield feature
+    finally:
+        jsonfile.close()
+
+def parseCoordinates(values, low, high):
+    """ Converts a column of coordinate strings into floats. Values which are
+    blank, unparseable or outside [low, high] are returned as None.
+    """
+    try:
+        coords = map(float, values)
+    except (TypeError, ValueError):
+        # At least one bad value: fall back to converting them one at a time.
+        coords = []
+        for value in values:
+            try:
+                coords.append(float(value))
+            except (TypeError, ValueError):
+                coords.append(None)
+
+    return [c if c is not None and low <= c <= high else None for c in coords]
+
 def getFeaturesFromLatLongCsvFile(collection, filename):
+    """ Generates point features from a .csv (or tab-delimited .txt) file with
+    'Latitude' and 'Longitude' columns.
+
+    Rows are read CSV_CHUNK_SIZE at a time and processed a column at a time:
+    coordinates are parsed and checked for a whole chunk at once, columns
+    that the collection doesn't map are dropped before any of their values
+    are decoded, and point WKB is built directly instead of through shapely.
+    """
     # This is a .csv file! 
-    csvfile = open(filename, "r")
+    csvfile = open(filename, "rb")
     if filename[-3:] == 'csv':
-        reader = UnicodeDictReader(csvfile)
+        reader = csv.reader(csvfile)
     if filename[-3:] == 'txt':
-        reader = UnicodeDictReader(csvfile, dialect=csv.excel_tab)
+        reader = csv.reader(csvfile, dialect=csv.excel_tab)
+
+    header = reader.next()
+    width = len(header)
+    if 'Latitude' not in header or 'Longitude' not in header:
+        logging.error("File %s does not have 'Latitude' and 'Longitude' columns." % filename)
+        exit(1)
+    lat_index = header.index('Latitude')
+    long_index = header.index('Longitude')
+
+    # Only keep the columns this collection will map.
+    if collection.mapped_fields is None:
+        collection.default_fields()
+    mapped_columns = [(index, name) for (index, name) in enumerate(header)
+        if str(name.lower()) in collection.mapped_fields]
+
+    provider = collection.get_provider()
+    collection_name = collection.get_name()
 
-    features = []
     feature_index = 0
-    for entry in reader:
-        feature_index += 1
-        feature = {}
-
-        # As per the spec at http://geojson.org/geojson-spec.html
-        feature['type'] = 'Feature'
-        feature['properties'] = entry
-
-        lat = entry['Latitude']
-        if not lat:
-            logging.warn("Feature %d has no latitude, ignoring." % feature_index)
-            continue # Ignore features without latitudes.
-        long = entry['Longitude']
-        if not long:
-            logging.warn("Feature %d has no longitude, ignoring." % feature_index)
-            continue # Ignore features without longitudes.
-
-        feature['geometry'] = {'type': 'Point', 'coordinates': [
-                float(entry['Longitude']),
-                float(entry['Latitude'])
-            ]}
-            # TODO: We assume latitude and longitude (in WGS84) are
-            # present in the columns 'Latitude' and 'Longitude'
-            # respectively.
-        
+    while True:
+        # Blank lines are skipped; short rows are padded out with None.
+        rows = [row if len(row) >= width else row + [None] * (width - len(row))
+            for row in itertools.islice(reader, CSV_CHUNK_SIZE) if row]
+        if len(rows) == 0:
+            break
+        columns = zip(*rows)
+
+        lats = parseCoordinates(columns[lat_index], -90.0, 90.0)
+        longs = parseCoordinates(columns[long_index], -180.0, 180.0)
+        decoded_columns = [(name, [v.decode('utf-8') if v is not None else None for v in columns[index]])
+            for (index, name) in mapped_columns]
+        wkbs = [WKB_POINT.pack(1, 1, long, lat) if lat is not None and long is not None else None
+            for (long, lat) in itertools.izip(longs, lats)]
+
+        for i in xrange(len(rows)):
+            feature_index += 1
+
+            if lats[i] is None:
+                logging.warn("Feature %d has no valid latitude ('%s'), ignoring." % (feature_index, columns[lat_index][i]))
+                continue # Ignore features without latitudes.
+            if longs[i] is None:
+                logging.warn("Feature %d has no valid longitude ('%s'), ignoring." % (feature_index, columns[long_index][i]))
+                continue # Ignore features without longitudes.
+
+            properties = dict((name, values[i]) for (name, values) in decoded_columns)
+            properties['provider'] = provider
+            properties['collection'] = collection_name
+            properties['filename'] = filename
+            properties['row'] = feature_index
+
+            # As per the spec at http://geojson.org/geojson-spec.html
             # IMPORTANT TODO: at the moment, we assume the incoming coordinates
             # are already in WGS84! THIS MIGHT NOT BE TRUE!
-
-        properties = feature['properties']
-        properties['provider'] = collection.get_provider()
-        properties['collection'] = collection.get_name()
-        properties['filename'] = filename
-        properties['row'] = feature_index
-                
-        yield(feature)
+            yield {
+                'type': 'Feature',
+                'properties': properties,
+                'geometry': {'type': 'Point', 'coordinates': [longs[i], lats[i]]},
+                'wkb': wkbs[i]
+            }
 
     csvfile.close()
 
@@ -410,6 +813,24 @@ def deletePreviousEntries(table_name, provider, collection):
 
     sendSQLStatementToCartoDB(sql)
 
+def encodeFeatureDeleteAsSQL(table_name, collection, feature_hash):
+    """Encodes a DELETE statement for a previously uploaded feature.
+
+    Arguments:
+        table_name: The name of the table to delete the feature from.
+        collection: The ProviderConfig.Collection the feature belongs to.
+        feature_hash: The hash of the feature to delete.
+
+    Returns: the DELETE statement.
+    """
+    tag = random.randint(100000, 99999999).__str__()
+    return "DELETE FROM %s WHERE provider=%s AND collection=%s AND featurehash=%s" % (
+        table_name, 
+        '$tag_' + tag + '$' + collection.get_provider() + '$tag_' + tag + '$',
+        '$tag_' + tag + '$' + collection.get_name() + '$tag_' + tag + '$',
+        '$tag_' + tag + '$' + feature_hash + '$tag_' + tag + '$'
+    )
+
 def encodeGeoJSONEntryAsSQL(entry, table_name):
     """Encodes a GeoJSON entry (i.e. an object fulfilling the Python 'geo' interface)
     into a CartoDB statement for upload to CartoDB.
@@ -418,23 +839,66 @@ def encodeGeoJSONEntryAsSQL(entry, table_name):
         entry: A GeoJSON row entry containing geometry and field information for upload.
         table_name: The name of the table to add this GeoJSON entry to.
 
-    Returns: none.
+    Returns: the INSERT statement, or "" if the geometry could not be parsed.
+    """
+    row = encodeGeoJSONEntryAsRow(entry)
+    if row is None:
+        return ""
+    return encodeRowsAsSQL([row], table_name)
+
+def encodeRowsAsSQL(rows, table_name):
+    """Encodes rows from encodeGeoJSONEntryAsRow() as a single (multi-row) INSERT
+    statement.
+
+    Rows don't need to have the same columns: the statement inserts into every
+    column used by any row, and rows without a value for a column get the
+    column's DEFAULT, just as if they had been inserted on their own.
+
+    Arguments:
+        rows: A list of rows, each a list of (column, SQL value) tuples.
+        table_name: The name of the table to insert the rows into.
+
+    Returns: the INSERT statement.
+    """
+    cols = []
+    seen = set()
+    for row in rows:
+        for (col, value) in row:
+            if col not in seen:
+                seen.add(col)
+                cols.append(col)
+
+    values = []
+    for row in rows:
+        row_values = dict(row)
+        values.append("(" + ", ".join(row_values.get(col, "DEFAULT") for col in cols) + ")")
+
+    return "INSERT INTO %(table_name)s (%(cols)s) VALUES %(values)s" % {
+            'table_name': table_name,
+            'cols': ", ".join(cols),
+            'values': ", ".join(values)
+        }
+
+def encodeGeoJSONEntryAsRow(entry):
+    """Encodes a GeoJSON entry (i.e. an object fulfilling the Python 'geo' interface)
+    into the column values of a CartoDB row.
+
+    Arguments:
+        entry: A GeoJSON row entry containing geometry and field information for upload.
+
+    Returns: a list of (column, SQL value) tuples, starting with the_geom, or 
+        None if the geometry could not be parsed.
     """
     
     # Determine the geometry for this object, by converting the GeoJSON
     # geometry representation into WKT.
     # geometry = "SRID=4326;" + shapely.geometry.asShape(entry['geometry']).wkb
-    try:
-        shape = shapely.geometry.asShape(entry['geometry'])
-        bounds = shape.bounds
-	geometry = shape.wkb.encode('hex')
-		# We can use SRID=4326 because we loaded it in that SRID from
-		# ogr2ogr.
-    except ValueError as e:
-	logging.error("Error parsing '%s' as geometry: %s" % (entry['geometry'], e))
-	# So we continue, skipping only this feature.
-	# Run the upload again to catch these "missing features".
-	return ""
+    wkb = getFeatureWKB(entry)
+    if wkb is None:
+        # So we continue, skipping only this feature.
+        # Run the upload again to catch these "missing features".
+        return None
+    geometry = wkb.encode('hex')
 
     # Store the bounds in the upload object.
     # Actually, DON'T. The schema can't handle it yet.
@@ -475,65 +939,388 @@ def encodeGeoJSONEntryAsSQL(entry, table_name):
         properties.values().__str__()
         ).hexdigest()[20:28] + "$"
 
-    # Turn the fields and values into an SQL statement.
-    sql = "INSERT INTO %(table_name)s (the_geom, %(cols)s) VALUES (%(st_multi)s(GeomFromWKB(decode(%(geometry)s, 'hex'), 4326)), %(values)s)" % {
-            'table_name': table_name,
+    # Turn the fields and values into SQL values.
+    the_geom = "%(st_multi)s(GeomFromWKB(decode(%(geometry)s, 'hex'), 4326))" % {
             'geometry': tag + geometry + tag,
-            'cols': ", ".join(fields),
-            'st_multi': "ST_Multi" if (entry['geometry']['type'] == 'Polygon') else "",
-            'values': tag + (tag + ", " + tag).join(values) + tag
+            'st_multi': "ST_Multi" if (entry['geometry']['type'] == 'Polygon') else ""
         }
 
-    return sql
+    return [('the_geom', the_geom)] + [(field, tag + value + tag) for (field, value) in zip(fields, values)]
+
+class SQLBatch(object):
+    """ Collects the SQL statements for a batch of features.
+
+    By default, every feature is sent as its own INSERT statement and the batch
+    is full once it holds max_statements statements (the -j option). If max_bytes
+    is set (the --batch-bytes option), features are combined into a single 
+    multi-row INSERT instead, and the batch is full once its SQL reaches 
+    max_bytes. Any other statements (such as DELETEs for replaced features) 
+    are run before the INSERT.
+
+    Statements added before a feature belong with it: when a batch is split,
+    a DELETE always ends up in the same half as the feature that replaces it.
+    """
+
+    def __init__(self, table_name, max_statements, max_bytes=0):
+        self.table_name = table_name
+        self.max_statements = max_statements
+        self.max_bytes = max_bytes
+        self.sql_statements = []
+        self.rows = []
+        self.feature_hashes = []
+        self.size = 0
+        # (statements, rows) counts at the end of each feature and the 
+        # statements before it: the places where the batch can be split.
+        self.feature_ends = []
+
+    def __len__(self):
+        return len(self.sql_statements) + len(self.rows)
+
+    def add_statement(self, sql):
+        """ Adds an SQL statement to the batch. """
+        self.sql_statements.append(sql)
+        self.size += len(sql) + 2
+
+    def add_feature(self, entry):
+        """ Adds an INSERT for a GeoJSON entry to the batch. A feature whose 
+        geometry can't be encoded is left out, and its hash isn't recorded, so
+        the upload journal won't count it as committed. """
+        row = encodeGeoJSONEntryAsRow(entry)
+        if row is None:
+            return
+
+        self.feature_hashes.append(entry['properties']['FeatureHash'])
+        if not self.max_bytes:
+            self.add_statement(encodeRowsAsSQL([row], self.table_name))
+            self.feature_ends.append((len(self.sql_statements), len(self.rows)))
+            return
+
+        self.rows.append(row)
+        self.size += sum(len(col) + len(value) + 4 for (col, value) in row)
+        self.feature_ends.append((len(self.sql_statements), len(self.rows)))
+
+    def is_full(self):
+        if self.max_bytes:
+            return self.size >= self.max_bytes
+        return len(self) >= self.max_statements
+
+    def statements(self):
+        """ Returns the list of SQL statements to send for this batch. """
+        if self.rows:
+            return self.sql_statements + [encodeRowsAsSQL(self.rows, self.table_name)]
+        return list(self.sql_statements)
+
+    def split(self):
+        """ Splits the batch into two halves, which run the same SQL as this 
+        batch if they are sent one after the other, between two features.
+        Returns None if the batch holds a single feature (with its 
+        statements), which can't be split. """
+        # Statements after the last feature (there are none while the batch 
+        # is being filled) would go with the second half.
+        ends = [end for end in self.feature_ends if end != (len(self.sql_statements), len(self.rows))]
+        if not ends:
+            return None
+        (statement_count, row_count) = ends[(len(ends) - 1) // 2]
+        feature_count = self.feature_ends.index((statement_count, row_count)) + 1
+
+        halves = (SQLBatch(self.table_name, self.max_statements, self.max_bytes),
+            SQLBatch(self.table_name, self.max_statements, self.max_bytes))
+        for (half, statements, rows, feature_hashes, feature_ends) in (
+            (halves[0], self.sql_statements[:statement_count], self.rows[:row_count], 
+                self.feature_hashes[:feature_count], self.feature_ends[:feature_count]),
+            (halves[1], self.sql_statements[statement_count:], self.rows[row_count:], 
+                self.feature_hashes[feature_count:], 
+                [(s - statement_count, r - row_count) for (s, r) in self.feature_ends[feature_count:]])):
+            for statement in statements:
+                half.add_statement(statement)
+            for row in rows:
+                half.rows.append(row)
+                half.size += sum(len(col) + len(value) + 4 for (col, value) in row)
+            half.feature_hashes = feature_hashes
+            half.feature_ends = feature_ends
+
+        return halves
+
+class AdaptiveBatchSize(object):
+    """ Decides how many bytes of SQL to put into each batch, from how long
+    CartoDB takes to run them.
+
+    The budget grows additively while batches finish well within the target
+    latency, and is halved whenever a batch takes longer than the target or 
+    fails (AIMD, as in TCP congestion control). It never goes below 
+    ADAPTIVE_MIN_BATCH_BYTES or above the given maximum. Upload workers 
+    report to the same object, so it is thread-safe.
+    """
+
+    def __init__(self, initial_bytes, maximum_bytes, target_latency):
+        self.bytes = min(max(initial_bytes, ADAPTIVE_MIN_BATCH_BYTES), maximum_bytes)
+        self.maximum_bytes = maximum_bytes
+        self.target_latency = target_latency
+        self.increment = max(ADAPTIVE_MIN_BATCH_BYTES, self.bytes // 4)
+        self.lock = threading.Lock()
+
+    def max_bytes(self):
+        """ Returns the current byte budget for a batch. """
+        return self.bytes
+
+    def observe(self, seconds, size, succeeded):
+        """ Adjusts the byte budget after a batch of 'size' bytes took 'seconds'. """
+        with self.lock:
+            previous = self.bytes
+            if not succeeded or seconds > self.target_latency:
+                self.bytes = max(ADAPTIVE_MIN_BATCH_BYTES, self.bytes // 2)
+            elif seconds < self.target_latency / 2 and size >= self.bytes // 2:
+                # Only grow on batches that were close to full: a short
+                # final batch tells us nothing about larger ones.
+                self.bytes = min(self.maximum_bytes, self.bytes + self.increment)
+
+            if self.bytes != previous:
+                logging.info("\t  Batch budget changed from %d to %d bytes (%d byte batch %s in %.2fs).",
+                    previous, self.bytes, size, "succeeded" if succeeded else "failed", seconds)
+
+class CartoDBServerError(CartoDBException):
+    """ Raised by SQLEndpoint when a request fails for any reason other than
+    an error in its SQL. """
+
+class SQLEndpoint(object):
+    """ A stand-in for the CartoDB client which sends SQL to any URL that 
+    answers like the CartoDB SQL API, such as the one started by benchmark.py.
+    """
+
+    def __init__(self, url):
+        self.url = url
+
+    def sql(self, sql):
+        try:
+            response = urllib2.urlopen(self.url, urllib.urlencode({'q': sql}))
+            return simplejson.loads(response.read())
+        except urllib2.HTTPError as e:
+            if e.code == 400:
+                # Like CartoDB, the endpoint couldn't run the SQL.
+                raise CartoDBException(e.read())
+            raise CartoDBServerError(e)
+        except (urllib2.URLError, ValueError) as e:
+            raise CartoDBServerError(e)
+
+def isStatementError(e):
+    """ Returns True if a CartoDBException was raised because CartoDB couldn't
+    run the SQL it was sent (a 400 response, reporting the SQL error), and 
+    False if it was a server error or the server couldn't be reached.
+    """
+    if isinstance(e, CartoDBServerError):
+        return False
+    # The CartoDB client reports any 500 response with this message.
+    return str(e) != 'internal server error'
+
+def createCartoDBClient():
+    """ Returns a new CartoDB client, logged in with the settings in cartodb.json. 
+    If --sql-endpoint is in use, returns a client for that endpoint instead.
+    """
+    if _getoptions().sql_endpoint:
+        return SQLEndpoint(_getoptions().sql_endpoint)
+
+    return CartoDB(
+        cartodb_settings['CONSUMER_KEY'],
+        cartodb_settings['CONSUMER_SECRET'],
+        cartodb_settings['user'],
+        cartodb_settings['password'],
+        cartodb_settings['user'],
+        host=cartodb_settings['domain'],
+        protocol=cartodb_settings['protocol'],
+        access_token_url=cartodb_settings['access_token_url']
+    )
+
+def sendBatchToCartoDB(batch, client=None, split=False):
+    """ Sends an SQLBatch to CartoDB as a single transaction.
 
-def sendSQLStatementToCartoDB(sql):
+    If --adaptive is in use, the time the batch took is reported to the 
+    batch sizer, and a batch that CartoDB reports an SQL error for is split 
+    in half and each half sent separately, until the feature that CartoDB 
+    won't accept has been found and skipped. Batches that fail with server 
+    errors, or while CartoDB can't be reached, aren't split: sending them in
+    pieces wouldn't help, so they are retried as often as any other 
+    statement. (Halves of a split batch aren't reported to the 
+    batch sizer: one bad feature shouldn't shrink every batch that follows.)
+
+    Returns: True if the whole batch was executed, False otherwise.
+    """
+    with benchmark.stage('encoding'):
+        sql = "; ".join(batch.statements())
+
+    if batch_sizer is None:
+        return sendSQLStatementToCartoDB(sql, client)
+
+    start = time.time()
+    errors = []
+    succeeded = sendSQLStatementToCartoDB(sql, client, tries=ADAPTIVE_TRIES, errors=errors)
+    if not split:
+        batch_sizer.observe(time.time() - start, len(sql), succeeded)
+    if succeeded:
+        return True
+
+    if not errors or not isStatementError(errors[-1]):
+        logging.warning("\t  Batch of %d SQL statements failed with a server error; retrying it.", len(batch))
+        if sendSQLStatementToCartoDB(sql, client, tries=SQL_TRIES - ADAPTIVE_TRIES):
+            return True
+        logging.error("\t  ERROR! Giving up on a batch of %d SQL statements after a server error.", len(batch))
+        return False
+
+    halves = batch.split()
+    if halves is None:
+        logging.error("\t  ERROR! Giving up on SQL statement <<%s...>> (%d bytes).", sql[:200], len(sql))
+        return False
+
+    logging.warning("\t  Batch of %d SQL statements failed; splitting it to find the failing statement.", len(batch))
+    (first, second) = halves
+    first_sent = sendBatchToCartoDB(first, client, split=True)
+    second_sent = sendBatchToCartoDB(second, client, split=True)
+    return first_sent and second_sent
+
+def sendSQLStatementToCartoDB(sql, client=None, tries=SQL_TRIES, errors=None):
     """ A helper method for sending an SQL statement (or multiple SQL statements in a 
     single string) to CartoDB. Note that cartodb is only initialized once; it is stored
     as a global, and reused on subsequent calls.
+
+    Arguments:
+        sql: The SQL statement(s) to execute in a single transaction.
+        client: The CartoDB client to use (defaults to the global client).
+        tries: How many times to try executing the statement.
+        errors: If given, a list that every CartoDBException caught is 
+            appended to.
+
+    Returns: True if the statement was executed (or a dummy run is in 
+        progress), False if it failed on every try.
     """
 
     global cartodb
     global cartodb_settings
 
-    if cartodb is None:
-        cartodb = CartoDB(
-            cartodb_settings['CONSUMER_KEY'],
-            cartodb_settings['CONSUMER_SECRET'],
-            cartodb_settings['user'],
-            cartodb_settings['password'],
-            cartodb_settings['user'],
-            host=cartodb_settings['domain'],
-            protocol=cartodb_settings['protocol'],
-            access_token_url=cartodb_settings['access_token_url']
-        )
-        
+    if client is None:
+        if cartodb is None:
+            cartodb = createCartoDBClient()
+        client = cartodb
+
     # Do these changes as a single transaction:
     sql = "BEGIN TRANSACTION; " + sql + "; COMMIT TRANSACTION;"
 
     # print "Executing SQL: «%s»" % sql
     if not _getoptions().dummy_run:
-        tries = 10
-
-        while (tries > 0):
-            try:
-                result = cartodb.sql(sql)
-            	tries = 0
-            except CartoDBException as e:
-                #if str(e) == 'internal server error' or str(e) == 'current transaction is aborted, commands ignored until end of transaction block':
-                logging.info("\t  CartoDB exception caught ('%s'), retrying ...", e)
-                time.sleep(random.randint(3,9))
-                result = None
-                tries = tries - 1 
+        with benchmark.stage('upload', bytes=len(sql)):
+            while (tries > 0):
+                try:
+                    result = client.sql(sql)
+                    tries = 0
+                except CartoDBException as e:
+                    #if str(e) == 'internal server error' or str(e) == 'current transaction is aborted, commands ignored until end of transaction block':
+                    logging.info("\t  CartoDB exception caught ('%s'), retrying ...", e)
+                    if errors is not None:
+                        errors.append(e)
+                    result = None
+                    tries = tries - 1 
+                    if tries > 0:
+                        time.sleep(random.randint(3,9))
 
         if result is None:
             logging.error("\t  ERROR! Unable to execute SQL statement <<%s>>; continuing.")
-            return
+            return False
 
         logging.info("\t  Result: %s" % result)
     else:
         logging.info("\t  SQL statement to execute: %s" % sql)
         logging.info("\t  Result: none (dummy run in progress)")
 
+    return True
+
+class UploadPool(object):
+    """ Sends batches of SQL statements to CartoDB from a pool of worker
+    threads, each with its own CartoDB client.
+
+    Batches wait in a bounded queue, so submit() blocks while all the 
+    workers are busy and the queue is full; the feature reader can never 
+    get more than a few batches ahead of the uploads. Each batch is sent as a 
+    single transaction (retried by sendSQLStatementToCartoDB), so statements 
+    inside a batch keep their order. Call join() to wait for every batch 
+    submitted so far, e.g. before starting on the next collection, and 
+    close() to stop the workers once every batch has been submitted.
+    """
+
+    # Queued after the last batch, once per worker, to stop the workers.
+    STOP = None
+
+    def __init__(self, workers, queue_size=None):
+        self.queue = Queue.Queue(queue_size or 2 * workers)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.batches = 0
+        self.statements = 0
+        self.bytes = 0
+        self.failures = 0
+
+        self.workers = []
+        for n in range(workers):
+            worker = threading.Thread(target=self._work, name="upload-%d" % (n + 1))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, batch, on_success=None):
+        """ Queues an SQLBatch to be sent. on_success, if given, is called 
+        from the worker once the batch has been executed.
+        """
+        self.queue.put((batch, on_success))
+
+    def join(self):
+        """ Waits until every submitted batch has been sent. """
+        self.queue.join()
+
+    def close(self):
+        """ Waits until every submitted batch has been sent, then stops the
+        workers. No more batches can be submitted. """
+        for worker in self.workers:
+            self.queue.put(self.STOP)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def _work(self):
+        # The client is created inside the try, so that a worker which can't
+        # create one still marks its batches done instead of hanging join().
+        client = None
+        while True:
+            item = self.queue.get()
+            if item is self.STOP:
+                self.queue.task_done()
+                return
+
+            (batch, on_success) = item
+            try:
+                if client is None:
+                    client = createCartoDBClient()
+                succeeded = sendBatchToCartoDB(batch, client)
+                if succeeded and on_success is not None:
+                    on_success()
+                self._record(len(batch), batch.size, succeeded)
+            except Exception as e:
+                logging.error("\t  Upload worker failed on a batch of %d SQL statements: %s", 
+                    len(batch), e)
+                self._record(len(batch), 0, False)
+            finally:
+                self.queue.task_done()
+
+    def _record(self, statement_count, byte_count, succeeded):
+        with self.lock:
+            self.batches += 1
+            if succeeded:
+                self.statements += statement_count
+                self.bytes += byte_count
+            else:
+                self.failures += 1
+
+            elapsed = max(time.time() - self.started, 0.001)
+            logging.info("\t  %d batches sent (%d failed), %d SQL statements at %.1f statements/s, %.1f KB/s.",
+                self.batches, self.failures, self.statements, 
+                self.statements / elapsed, self.bytes / 1024.0 / elapsed)
+
 cmdline_options = None
 def _getoptions():
     ''' Returns the parsed command line options.'''
@@ -570,6 +1357,51 @@ def parse_cmdline():
                       metavar="N",
                       default="3",
                       help="How many SQL statements should we upload at once?")
+    parser.add_option('--batch-bytes',
+                      type="int",
+                      action="store",
+                      dest="batch_bytes",
+                      metavar="BYTES",
+                      default="0",
+                      help="Combine features into multi-row INSERT statements of about this many bytes, instead of sending -j single-row INSERTs at a time.")
+    parser.add_option('--adaptive',
+                      action="store_true",
+                      dest="adaptive",
+                      help="Send multi-row INSERT batches whose size adapts to how quickly CartoDB runs them, starting from --batch-bytes; failed batches are split to find the failing feature instead of being retried.")
+    parser.add_option('--max-batch-bytes',
+                      type="int",
+                      action="store",
+                      dest="max_batch_bytes",
+                      metavar="BYTES",
+                      default=str(4 * 1024 * 1024),
+                      help="With --adaptive, never send batches larger than this many bytes.")
+    parser.add_option('--target-latency',
+                      type="float",
+                      action="store",
+                      dest="target_latency",
+                      metavar="SECONDS",
+                      default="10",
+                      help="With --adaptive, shrink batches that take longer than this, and grow batches that take less than half of it.")
+    parser.add_option('--workers',
+                      type="int",
+                      action="store",
+                      dest="workers",
+                      metavar="N",
+                      default="1",
+                      help="How many batches of SQL statements should we upload in parallel, each over its own CartoDB connection?")
+    parser.add_option('--convert-workers',
+                      type="int",
+                      action="store",
+                      dest="convert_workers",
+                      metavar="N",
+                      default="2",
+                      help="How many shapefiles should we convert to GeoJSON with ogr2ogr at once?")
+    parser.add_option('--journal',
+                      type="string",
+                      action="store",
+                      dest="journal_dir",
+                      metavar="DIR",
+                      help="Keep an upload journal for each collection in DIR, so that an interrupted upload can be resumed by running the same command again.")
     parser.add_option('--no-validate', '-V',
                       action="store_true",
                       dest="no_validate",
@@ -590,6 +1422,20 @@ def parse_cmdline():
                       dest="reset_collection",
                       help="Resets the table by deleting all records in a collection before uploading that collection."
     )
+    parser.add_option('--benchmark',
+                      type="string",
+                      action="store",
+                      dest="benchmark_file",
+                      metavar="FILE",
+                      help="Time each stage of the upload (conversion, parsing, mapping, hashing, encoding, upload) and write a JSON report to FILE."
+    )
+    parser.add_option('--sql-endpoint',
+                      type="string",
+                      action="store",
+                      dest="sql_endpoint",
+                      metavar="URL",
+                      help="Send SQL to this URL instead of CartoDB, e.g. the stand-in endpoint started by 'python benchmark.py'."
+    )
     parser.add_option('--marktime',
                       action="store_true",
                       dest="mark_time",
@@ -621,13 +1467,30 @@ def main():
 
     # Load up the cartodb settings: we'll need them later.
     global cartodb_settings
+    if not options.sql_endpoint:
+        try:
+            cartodb_settings = simplejson.loads(
+                codecs.open('cartodb.json', encoding='utf-8').read(), 
+                encoding='utf-8')
+        except Exception as ex:
+            logging.error("Could not load CartoDB setting file 'cartodb.json': %s" % ex)
+            exit(1)
+
+    global benchmark
+    if options.benchmark_file:
+        benchmark = Benchmark()
+        # We change directories while uploading.
+        benchmark_file = os.path.abspath(options.benchmark_file)
+
     try:
-        cartodb_settings = simplejson.loads(
-            codecs.open('cartodb.json', encoding='utf-8').read(), 
-            encoding='utf-8')
-    except Exception as ex:
-        logging.error("Could not load CartoDB setting file 'cartodb.json': %s" % ex)
-        exit(1)
+        uploadSourceDirs(options)
+    finally:
+        if options.benchmark_file:
+            benchmark.write(benchmark_file)
+
+def uploadSourceDirs(options):
+    """ Uploads the source directory given on the command line, or every
+    source directory in DEFAULT_DATASETS_DIR."""
 
     # Has the user provided a source directory? 
     if options.source_dir is None:
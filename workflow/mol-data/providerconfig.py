@@ -75,6 +75,8 @@ class ProviderConfig(object):
                 fields['required']['collection'] = self.collection['collection'].lower()
 
             self.mapped_fields = None
+            self.field_defaults = None
+            self.required_fieldset = None
 
             # NOTE: No longer being autovalidated! Please call ProviderConfig.validate()
             # to validate.
@@ -96,14 +98,13 @@ class ProviderConfig(object):
             return cols
 
         def verify_fields(self, filename, properties):
-            required_fields = self.collection['fields']['required'].keys()
+            if self.required_fieldset is None:
+                self.required_fieldset = frozenset(self.collection['fields']['required'].keys())
 
-            required_fieldset = set(required_fields)
-            properties_keyset = set(properties.keys())
-
-            if len(required_fieldset.difference(properties_keyset)) > 0:
+            missing_fields = self.required_fieldset.difference(properties)
+            if len(missing_fields) > 0:
                 logging.error("The following required fields are not defined in file %s: %s" %
-                    (filename, ", ".join(required_fieldset.difference(properties_keyset))))
+                    (filename, ", ".join(missing_fields)))
                 sys.exit(1)
 
             # Some "manual" validation. Eventually, this will happen
@@ -171,6 +172,55 @@ class ProviderConfig(object):
             # No mapping? Okay then.
             return (None, None)
             
+        def mapping_plan(self, source_fields):
+            """ Compiles the field mapping for rows with the given source fields
+            (e.g. the columns of a DBF or CSV file), so that map_field() doesn't 
+            need to be called for every field of every row.
+
+            Returns a list of (source field, target field, required) tuples, one
+            for every source field that is mapped, in the order given. required
+            is None for a target field that isn't in the spec; like map_field(),
+            apply_mapping_plan() only reports that once a value is missing.
+            """
+            if self.field_defaults is None:
+                self.field_defaults = self.default_fields()
+
+            fields = self.collection['fields']
+            plan = []
+            for name in source_fields:
+                field_to_map_to = self.mapped_fields.get(str(name.lower()))
+                if field_to_map_to is None:
+                    continue
+                if field_to_map_to in fields['required'].keys():
+                    required = True
+                elif field_to_map_to in fields['optional'].keys():
+                    required = False
+                else:
+                    required = None
+                plan.append((name, field_to_map_to, required))
+            return plan
+
+        def apply_mapping_plan(self, plan, row_no, properties):
+            """ Maps a row's properties using a plan from mapping_plan(), and 
+            returns the new properties (including the default fields).
+            """
+            new_properties = self.field_defaults.copy()
+            for (name, field_to_map_to, required) in plan:
+                specified_value = properties[name]
+
+                # Quick check for 'blank' mappings.
+                if specified_value is None or specified_value == '':
+                    if required is None:
+                        required = self.is_required(field_to_map_to)
+                    if required:
+                        logging.error("Required field '%s' is mapped from DBF column '%s', but row %d is missing a value in this dataset." % (field_to_map_to, name.lower(), row_no))
+                        exit(1)
+                    # No point mapping to a blank value.
+                    continue
+
+                new_properties[field_to_map_to] = unicode(specified_value)
+            return new_properties
+
         def is_required(self, fieldname):
             """ Returns true if a particular field is required, false if optional. """
             if fieldname in self.collection['fields']['required'].keys():
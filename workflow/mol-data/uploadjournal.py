@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Gaurav Vaidya
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""This code keeps an on-disk journal of a collection's upload.
+
+loader.py records every batch it sends in a per-collection SQLite file:
+which feature hashes went into the batch, and whether CartoDB committed it.
+When an interrupted upload is restarted, features in committed batches are
+skipped without asking the server, and features from batches that were still
+in flight are sent again (after deleting any copy the server might have
+committed before the connection dropped).
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+class UploadJournal(object):
+    """The upload journal for a single table/provider/collection."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            committed INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS features (
+            hash TEXT PRIMARY KEY,
+            batch_id INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS features_batch_id ON features (batch_id);
+    """
+
+    # The batch that feature hashes downloaded from CartoDB are filed under.
+    SERVER_BATCH = 0
+
+    def __init__(self, journal_dir, table_name, provider, collection):
+        """Opens (or creates) the journal for a collection in journal_dir."""
+        if not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+
+        name = "%s-%s-%s.sqlite" % (table_name, provider, collection)
+        self.filename = os.path.join(journal_dir, re.sub(r'[^\w.-]', '_', name))
+
+        # Batches are committed from the upload worker threads.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.filename, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+        self.db.execute("INSERT OR IGNORE INTO batches (id, committed) VALUES (?, 1)", (self.SERVER_BATCH,))
+        self.db.commit()
+
+        logging.info("Using upload journal '%s'.", self.filename)
+
+    def get(self, key, default=None):
+        """Returns a value stored in the journal's metadata."""
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def set(self, key, value):
+        """Stores a value in the journal's metadata."""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+            self.db.commit()
+
+    def clear(self):
+        """Forgets everything, e.g. after the collection was deleted from the server."""
+        with self.lock:
+            self.db.executescript("DELETE FROM meta; DELETE FROM features; DELETE FROM batches WHERE id <> %d;" % self.SERVER_BATCH)
+            self.db.commit()
+
+    def record_server_hashes(self, feature_hashes):
+        """Records hashes already on the server, so later runs don't need to
+        download them again."""
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO features (hash, batch_id) VALUES (?, %d)" % self.SERVER_BATCH,
+                ((feature_hash,) for feature_hash in feature_hashes))
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('server_hashes', '1')")
+            self.db.commit()
+
+    def has_server_hashes(self):
+        """Returns true if the server's hashes were recorded by an earlier run."""
+        return self.get('server_hashes') == '1'
+
+    def committed_hashes(self):
+        """Generates the hashes of every feature known to be on the server."""
+        for (feature_hash,) in self.db.execute(
+            "SELECT f.hash FROM features f JOIN batches b ON f.batch_id = b.id WHERE b.committed = 1"):
+            yield feature_hash
+
+    def in_flight_hashes(self):
+        """Returns the set of hashes in batches that were sent but never
+        confirmed: the server may or may not have committed them."""
+        return set(feature_hash for (feature_hash,) in self.db.execute(
+            "SELECT f.hash FROM features f JOIN batches b ON f.batch_id = b.id WHERE b.committed = 0"))
+
+    def begin_batch(self, feature_hashes):
+        """Records that a batch containing these feature hashes is about to be
+        sent, and returns its batch id."""
+        with self.lock:
+            cursor = self.db.execute("INSERT INTO batches (committed) VALUES (0)")
+            batch_id = cursor.lastrowid
+            self.db.executemany(
+                "INSERT OR REPLACE INTO features (hash, batch_id) VALUES (?, ?)",
+                ((feature_hash, batch_id) for feature_hash in feature_hashes))
+            self.db.commit()
+        return batch_id
+
+    def commit_batch(self, batch_id):
+        """Records that the server committed a batch."""
+        with self.lock:
+            self.db.execute("UPDATE batches SET committed = 1 WHERE id = ?", (batch_id,))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()